@@ -1,22 +1,33 @@
 import micropython
-import json
 from utime import sleep, time, localtime
 from machine import Timer
 from urandom import randint
-import _thread
 
 class AlarmManager:
+    EVERY_DAY = 0x7F # weekday mask, bit 0 is monday like localtime()[6]
+    MINUTES_PER_DAY = 1440
+    MINUTES_PER_WEEK = 7 * 1440
+    ALARM_LEAD_MINUTES = 5 # the alarm is raised this long before its time, so the sunrise is done when the sound starts
+    ALARM_LATE_MINUTES = 3 # an alarm missed by up to this much, e.g. while booting, is still raised
+    ALARM_SOUND_DELAY = 300 # s after raising
+    ALARM_QUIT_DELAY = 600 # s after raising
+    ALARM_MAX_WAIT = 3600000 # ms, longer waits are split up, so a drifting or updated RTC is picked up
+
     def __init__(self, state_mgr):
         self.state_mgr = state_mgr
         self.alarm_timer = None
+        self.alarm_timer_callback_ref = self.alarm_timer_callback # bound once, so re-arming does not allocate
+        self.on_alarm_timer_scheduled_ref = self.on_alarm_timer_scheduled
         self.alarm_active = False
         self.alarm_raised = False
-        self.alarm_time = '{:02d}:{:02d}'.format(0,0) # ToDo: move to AlarmManager
-        self.alarm_raised = False # ToDo: move to AlarmManager 
+        # alarms as [minute of day, weekday mask, enabled], the menu edits the first one
+        self.alarms = [[0, self.EVERY_DAY, True]]
+        # raise times as minute of week, sorted, rebuilt only when alarms change
+        self.alarm_fire_index = []
+        self.build_alarm_fire_index()
         self.alarm_raised_time = None
         self.last_alarm_stopped_time = None
         self.alarm_quit_button_sequence = []
-        self.alarm_sequence_thread = None
         self.alarm_sequence_running = False
         self.alarm_sequence_sound_running = False
     
@@ -28,6 +39,7 @@ class AlarmManager:
         self.state_mgr.log_emit(f'Alarm active: {self.alarm_active}', self.__class__.__name__)
         self.alarm_active = value
         self.write_alarm_active()
+        self.reschedule()
 
     def is_alarm_active(self):
         return self.alarm_active
@@ -39,40 +51,151 @@ class AlarmManager:
         return self.alarm_raised
     
     def set_alarm_time(self, time):
-        self.alarm_time = time
+        # "HH:MM" of the first alarm, as edited in the menu
+        hours, minutes = time.split(':')
+        self.set_alarm(0, minute=int(hours) * 60 + int(minutes))
 
     def get_alarm_time(self):
-        return self.alarm_time
-    
+        minute = self.alarms[0][0]
+        return '{:02d}:{:02d}'.format(minute // 60, minute % 60)
+
+    # region alarms
+    def get_alarms(self):
+        return self.alarms
+
+    def add_alarm(self, minute, weekdays=EVERY_DAY, enabled=True):
+        self.alarms.append([minute, weekdays, enabled])
+        self.alarms_changed()
+        return len(self.alarms) - 1
+
+    def remove_alarm(self, index):
+        self.alarms.pop(index)
+        self.alarms_changed()
+
+    def set_alarm(self, index, minute=None, weekdays=None, enabled=None):
+        alarm = self.alarms[index]
+        if minute is not None:
+            alarm[0] = minute % self.MINUTES_PER_DAY
+        if weekdays is not None:
+            alarm[1] = weekdays
+        if enabled is not None:
+            alarm[2] = enabled
+        self.alarms_changed()
+
+    def alarms_changed(self):
+        self.build_alarm_fire_index()
+        self.reschedule()
+
+    def build_alarm_fire_index(self):
+        index = []
+        for minute, weekdays, enabled in self.alarms:
+            if not enabled:
+                continue
+            for day in range(7):
+                if weekdays & (1 << day):
+                    index.append((day * self.MINUTES_PER_DAY + minute - self.ALARM_LEAD_MINUTES) % self.MINUTES_PER_WEEK)
+        index.sort()
+        self.alarm_fire_index = index
+
+    def get_week_minute(self, now):
+        return now[6] * self.MINUTES_PER_DAY + now[3] * 60 + now[4]
+
+    def get_due_alarm(self, now):
+        # the raise time of an alarm that should be ringing right now, None if there is none
+        week_minute = self.get_week_minute(now)
+        for fire in self.alarm_fire_index:
+            if (week_minute - fire) % self.MINUTES_PER_WEEK <= self.ALARM_LEAD_MINUTES + self.ALARM_LATE_MINUTES:
+                return fire
+        return None
+
+    def get_next_fire_delay(self, now):
+        # ms until the next raise time, None if no alarm is enabled
+        if not self.alarm_fire_index:
+            return None
+        week_second = self.get_week_minute(now) * 60 + now[5]
+        for fire in self.alarm_fire_index:
+            if fire * 60 > week_second:
+                return (fire * 60 - week_second) * 1000
+        return ((self.alarm_fire_index[0] + self.MINUTES_PER_WEEK) * 60 - week_second) * 1000
+
+    def get_now(self):
+        return localtime()
+    # endregion
+
+    # defaults come from settings/alarm.json, changes go to the settings journal, both through the settings manager
     def read_alarm_time(self):
-        with open('settings//alarm.json', 'r') as file:
-            data = json.load(file)
-            self.set_alarm_time(data['alarm_time'])
+        alarms = self.state_mgr.settings_get('alarm', 'alarms')
+        if alarms is not None:
+            self.alarms = [[alarm['minute'], alarm['weekdays'], alarm['enabled']] for alarm in alarms]
+            self.alarms_changed()
+        else:
+            self.set_alarm_time(self.state_mgr.settings_get('alarm', 'alarm_time', '00:00'))
 
     def write_alarm_time(self):
-        with open('settings//alarm.json', 'r') as file:
-            data = json.load(file)
-        data['alarm_time'] = self.get_alarm_time()
-        with open('settings//alarm.json', 'w') as file:
-            json.dump(data, file)
+        self.state_mgr.settings_remove('alarm', 'alarm_time')
+        self.state_mgr.settings_set('alarm', 'alarms', [{'minute': minute, 'weekdays': weekdays, 'enabled': enabled} for minute, weekdays, enabled in self.alarms])
         self.state_mgr.log_emit(f'Alarm time: {self.get_alarm_time()}', self.__class__.__name__)    
 
     def read_alarm_active(self):
-        with open('settings//alarm.json', 'r') as file:
-            data = json.load(file)
-            self.set_alarm_active(data['alarm_active'])
+        self.set_alarm_active(self.state_mgr.settings_get('alarm', 'alarm_active', False))
 
     def write_alarm_active(self):
-        with open('settings//alarm.json', 'r') as file:
-            data = json.load(file)
-        data['alarm_active'] = self.is_alarm_active()
-        with open('settings//alarm.json', 'w') as file:
-            json.dump(data, file)
+        self.state_mgr.settings_set('alarm', 'alarm_active', self.is_alarm_active())
 
     def start_alarm_timer(self):
+        # one one shot timer, armed for whatever comes next: raising the next alarm, or the sound and the auto quit while raised
         if self.alarm_timer is None:
             self.state_mgr.log_emit("Alarm timer started", self.__class__.__name__)
-            self.alarm_timer = Timer(period=30000, mode=Timer.PERIODIC,callback=lambda t: self.check_alarm())
+            self.alarm_timer = Timer()
+            self.schedule_next_alarm()
+
+    def arm_alarm_timer(self, period):
+        self.alarm_timer.init(mode=Timer.ONE_SHOT, period=max(1, period), callback=self.alarm_timer_callback_ref)
+
+    def alarm_timer_callback(self, _):
+        try:
+            micropython.schedule(self.on_alarm_timer_scheduled_ref, None)
+        except RuntimeError:
+            self.arm_alarm_timer(100) # schedule queue is full, try again shortly
+
+    def on_alarm_timer_scheduled(self, _):
+        if self.alarm_timer is not None:
+            self.on_alarm_timer()
+
+    def on_alarm_timer(self):
+        if self.is_alarm_raised():
+            elapsed = time() - self.alarm_raised_time
+            if elapsed >= self.ALARM_QUIT_DELAY:
+                self.quit_alarm()
+            elif elapsed >= self.ALARM_SOUND_DELAY:
+                if not self.alarm_sequence_sound_running:
+                    self.alarm_sequence_sound_running = True
+                    self.state_mgr.sound_alarm_sequence()
+                self.arm_alarm_timer((self.ALARM_QUIT_DELAY - elapsed) * 1000)
+            else:
+                self.arm_alarm_timer((self.ALARM_SOUND_DELAY - elapsed) * 1000)
+        else:
+            self.schedule_next_alarm()
+
+    def schedule_next_alarm(self):
+        if self.alarm_timer is None or self.is_alarm_raised():
+            return
+        now = self.get_now()
+        if self.is_alarm_active() and not self.is_last_alarm_just_stopped() and self.get_due_alarm(now) is not None:
+            self.raise_alarm()
+            return
+        delay = self.get_next_fire_delay(now)
+        if not self.is_alarm_active() or delay is None:
+            self.alarm_timer.deinit() # nothing to wait for, set_alarm_active or a changed alarm arms it again
+            return
+        # the RTC only has whole seconds, waking up a little early just arms the timer once more for the rest
+        self.arm_alarm_timer(min(delay, self.ALARM_MAX_WAIT))
+
+    def reschedule(self):
+        # alarms, the active flag or the RTC changed
+        if self.alarm_timer is not None and not self.is_alarm_raised():
+            self.alarm_timer.deinit()
+            self.schedule_next_alarm()
         
     def stop_alarm_timer(self):
         if self.alarm_timer is not None:
@@ -93,35 +216,6 @@ class AlarmManager:
                 return True
         return False
 
-    @micropython.native
-    def check_alarm(self):
-        if self.is_alarm_active() and not self.is_alarm_raised() and not self.is_last_alarm_just_stopped():
-            current_time = localtime()
-            current_hours = current_time[3]
-            current_minutes = current_time[4]
-            alarm_hours, alarm_minutes = map(int, self.get_alarm_time().split(':'))
-            self.state_mgr.log_emit(f'Alarm time: {self.get_alarm_time()} Current time: {current_hours}:{current_minutes}', self.__class__.__name__)
-        
-            time_diff = (current_hours * 60 + current_minutes) - (alarm_hours * 60 + alarm_minutes)
-            
-            if time_diff < -30:
-                time_diff += 24 * 60
-        
-            if -5 <= time_diff <= 3:
-                if not self.is_alarm_raised():
-                    self.raise_alarm()
-        elif self.is_alarm_raised():
-            if self.alarm_raised_time is not None:
-                self.state_mgr.log_emit(f"elapsed seconds since alarm raised: {time() - self.alarm_raised_time}", self.__class__.__name__)
-            if self.alarm_raised_time is not None:
-                if time() - self.alarm_raised_time >= 300:
-                    if not self.alarm_sequence_sound_running:
-                        self.alarm_sequence_sound_running = True
-                        self.state_mgr.sound_alarm_sequence()
-                if time() - self.alarm_raised_time >= 600:
-                    self.quit_alarm()
-                    self.alarm_raised_time = None
-
     @micropython.native
     def randomize_quit_button_sequenze(self):
         colors = ['green', 'blue', 'yellow']
@@ -136,36 +230,32 @@ class AlarmManager:
     def remove_first_quit_button_sequence(self):
         self.alarm_quit_button_sequence.pop(0)
 
-    @micropython.native
     def alarm_sequence(self):
+        # a generator of neopixel animations, the NeoPixelManager steps it frame by frame and drops it when the alarm is quit
+        # the sound is started by on_alarm_timer at the 300 s mark, once the sunrise is over
         self.set_alarm_sequence_running(True)
-        self.state_mgr.neopixel_all_off()
-        self.state_mgr.neopixel_sunrise(duration=300)
-        self.state_mgr.sound_alarm_sequence() # async, non-blocking
-        while self.is_alarm_raised():
-            for i in range(7):
-                if not self.is_alarm_raised():
-                    break
-                if i == 0: 
-                    self.state_mgr.neopixel_all_off()
-                elif i == 1: 
-                    self.state_mgr.neopixel_turning_wheel(self.state_mgr.neopixel_get_color(255, 255, 255), delay=0.3, loops=10)
-                elif i == 2: 
-                    self.state_mgr.neopixel_all_off()
-                elif i == 3: 
-                    self.state_mgr.neopixel_chase([self.state_mgr.neopixel_get_color(255, 0, 0), self.state_mgr.neopixel_get_color(0, 255, 0), self.state_mgr.neopixel_get_color(0, 0, 255), self.state_mgr.neopixel_get_color(255, 255, 0), self.state_mgr.neopixel_get_color(0, 255, 255)], delay=0.1, loops=5)
-                elif i == 4: 
-                    self.state_mgr.neopixel_all_off()
-                elif i == 5: 
-                    self.state_mgr.neopixel_pendulum([self.state_mgr.neopixel_get_color(255, 0, 0), self.state_mgr.neopixel_get_color(0, 255, 0), self.state_mgr.neopixel_get_color(0, 0, 255)], delay=0.1, loops=5)
-                elif i == 6: 
-                    self.state_mgr.neopixel_all_off() 
-        self.state_mgr.neopixel_all_off()
-        self.set_alarm_sequence_running(False)
-
-    def start_alarm_sequence_thread(self):
-        _thread.stack_size(6*1024) # the default stack size (4kb) is too small once the thread is started. Max. recursion depth exceptions will occur anywhere.  
-        self.alarm_sequence_thread = _thread.start_new_thread(lambda: self.alarm_sequence(), ())
+        try:
+            yield from self.state_mgr.neopixel_off_animation()
+            yield from self.state_mgr.neopixel_sunrise_animation(duration=300)
+            white = self.state_mgr.neopixel_get_color(255, 255, 255)
+            red = self.state_mgr.neopixel_get_color(255, 0, 0)
+            green = self.state_mgr.neopixel_get_color(0, 255, 0)
+            blue = self.state_mgr.neopixel_get_color(0, 0, 255)
+            yellow = self.state_mgr.neopixel_get_color(255, 255, 0)
+            cyan = self.state_mgr.neopixel_get_color(0, 255, 255)
+            while self.is_alarm_raised():
+                yield from self.state_mgr.neopixel_off_animation()
+                yield from self.state_mgr.neopixel_turning_wheel_animation(white, delay=0.3, loops=10)
+                yield from self.state_mgr.neopixel_off_animation()
+                yield from self.state_mgr.neopixel_chase_animation([red, green, blue, yellow, cyan], delay=0.1, loops=5)
+                yield from self.state_mgr.neopixel_off_animation()
+                yield from self.state_mgr.neopixel_pendulum_animation([red, green, blue], delay=0.1, loops=5)
+            yield from self.state_mgr.neopixel_off_animation()
+        finally:
+            self.set_alarm_sequence_running(False)
+
+    def start_alarm_sequence(self):
+        self.state_mgr.neopixel_start_animation(self.alarm_sequence())
     
     def set_alarm_sequence_running(self, value):
         self.alarm_sequence_running = value
@@ -183,8 +273,10 @@ class AlarmManager:
         self.alarm_raised_time = time()
         self.state_mgr.neopixel_stop_update_analog_clock_timer()
         self.state_mgr.neopixel_all_off()
-        self.start_alarm_sequence_thread()
+        self.start_alarm_sequence()
         self.display_first_quit_button_sequence()
+        if self.alarm_timer is not None:
+            self.arm_alarm_timer(self.ALARM_SOUND_DELAY * 1000)
         self.state_mgr.log_emit("Alarm raised: done", self.__class__.__name__)
         
     @micropython.native
@@ -193,12 +285,14 @@ class AlarmManager:
         self.set_last_alarm_stopped_time(time())
         self.set_alarm_raised(False)
         self.alarm_raised_time = None
+        self.state_mgr.neopixel_stop_animation()
         self.state_mgr.neopixel_all_off()
         self.state_mgr.sound_alarm_stop()
         self.alarm_sequence_sound_running = False
         self.state_mgr.display_clear_first_row()
         self.state_mgr.menu_set_state('idle')
         self.state_mgr.display_compose()
+        self.reschedule()
         self.state_mgr.log_emit("Alarm quit: done", self.__class__.__name__)
         
     def deinit(self):
@@ -214,9 +308,20 @@ class MockStateManager:
         self.alarm_time = "00:00"
         self.alarm_active = False
         self.alarm_raised = False
+        self.animation = None
+        self.settings = {}
 
     def log_emit(self, message, source):
         print(f"{source}: {message}")
+
+    def settings_get(self, name, key, default=None):
+        return self.settings.get(key, default)
+
+    def settings_set(self, name, key, value):
+        self.settings[key] = value
+
+    def settings_remove(self, name, key):
+        self.settings.pop(key, None)
     
     def alarm_set_alarm_raised(self, value):
         self.alarm_raised = value
@@ -227,8 +332,8 @@ class MockStateManager:
     def menu_set_state(self, state):
         pass
 
-    def neopixel_get_color(self, color):
-        pass
+    def neopixel_get_color(self, red, green, blue):
+        return (red, green, blue)
 
     def neopixel_stop_update_analog_clock_timer(self):
         pass
@@ -236,17 +341,28 @@ class MockStateManager:
     def neopixel_all_off(self):
         pass
 
-    def neopixel_sunrise(self, duration):
-        pass
+    def neopixel_start_animation(self, animation):
+        self.animation = animation
 
-    def neopixel_turning_wheel(self, color, delay, loops):
-        pass
+    def neopixel_stop_animation(self):
+        if self.animation is not None:
+            self.animation.close()
+            self.animation = None
 
-    def neopixel_chase(self, colors, delay, loops):
-        pass
+    def neopixel_off_animation(self):
+        yield 100
 
-    def neopixel_pendulum(self, colors, delay, loops):
-        pass
+    def neopixel_sunrise_animation(self, duration):
+        yield 1000
+
+    def neopixel_turning_wheel_animation(self, color, delay, loops):
+        yield int(delay * 1000)
+
+    def neopixel_chase_animation(self, colors, delay, loops):
+        yield int(delay * 1000)
+
+    def neopixel_pendulum_animation(self, colors, delay, loops):
+        yield int(delay * 1000)
 
     def display_alarm_quit_sequence(self, index):
         pass
@@ -299,4 +415,65 @@ def alarm_manager_randomizes_quit_button_sequence():
     #[WHEN]: AlarmManager randomizes quit button sequence
     alarm_mgr.randomize_quit_button_sequenze()
     #[THEN]: AlarmManager quit button sequence is randomized
-    print(alarm_mgr.alarm_quit_button_sequence)
\ No newline at end of file
+    print(alarm_mgr.alarm_quit_button_sequence)
+
+def alarm_manager_quit_stops_light_show():
+    #[GIVEN]: AlarmManager instance with a raised alarm
+    print("Test AlarmManager quit stops light show")
+    state_mgr = MockStateManager()
+    alarm_mgr = AlarmManager(state_mgr)
+    alarm_mgr.raise_alarm()
+    #[WHEN]: the light show has been stepped past the sunrise
+    for _ in range(5):
+        next(state_mgr.animation)
+    assert alarm_mgr.is_alarm_sequence_running(), "Expected the light show to run"
+    #[WHEN]: AlarmManager quits alarm
+    alarm_mgr.quit_alarm()
+    #[THEN]: the light show is dropped right away, no thread left to wind down
+    assert state_mgr.animation is None, "Expected the animation to be stopped"
+    assert not alarm_mgr.is_alarm_sequence_running(), "Expected the light show to be done"
+
+def alarm_manager_finds_next_fire_time():
+    #[GIVEN]: AlarmManager instance with a weekday and a weekend alarm
+    print("Test AlarmManager next fire time")
+    state_mgr = MockStateManager()
+    alarm_mgr = AlarmManager(state_mgr)
+    alarm_mgr.set_alarm(0, minute=7 * 60, weekdays=0x1F)
+    alarm_mgr.add_alarm(9 * 60 + 30, weekdays=0x60)
+    #[WHEN]: it is friday 08:00:00
+    friday = (2024, 5, 3, 8, 0, 0, 4, 124)
+    #[THEN]: the next raise is saturday 09:25, five minutes before the alarm
+    expected = ((24 * 60 + 85) * 60) * 1000
+    assert alarm_mgr.get_next_fire_delay(friday) == expected, "Expected {} ms, got {}".format(expected, alarm_mgr.get_next_fire_delay(friday))
+    #[WHEN]: it is sunday 23:59:30
+    sunday = (2024, 5, 5, 23, 59, 30, 6, 126)
+    #[THEN]: the next raise is monday 06:55, across the end of the week
+    expected = (30 + (6 * 60 + 55) * 60) * 1000
+    assert alarm_mgr.get_next_fire_delay(sunday) == expected, "Expected the week to wrap around"
+    #[WHEN]: the weekend alarm is disabled
+    alarm_mgr.set_alarm(1, enabled=False)
+    #[THEN]: friday 08:00 waits for monday
+    expected = ((3 * 24 * 60 - 65) * 60) * 1000
+    assert alarm_mgr.get_next_fire_delay(friday) == expected, "Expected the disabled alarm to be skipped"
+
+def alarm_manager_raises_when_timer_fires():
+    #[GIVEN]: AlarmManager instance with an active alarm at 07:00 every day
+    print("Test AlarmManager raises on timer")
+    state_mgr = MockStateManager()
+    alarm_mgr = AlarmManager(state_mgr)
+    alarm_mgr.alarm_active = True
+    alarm_mgr.set_alarm_time('07:00')
+    now = [2024, 5, 3, 6, 54, 59, 4, 124]
+    alarm_mgr.get_now = lambda: now
+    #[WHEN]: the timer is started a second before the raise time
+    alarm_mgr.start_alarm_timer()
+    #[THEN]: nothing is raised yet
+    assert not alarm_mgr.is_alarm_raised(), "Expected no alarm before its time"
+    #[WHEN]: the timer fires at the raise time
+    now[4], now[5] = 55, 0
+    alarm_mgr.on_alarm_timer()
+    #[THEN]: the alarm is raised
+    assert alarm_mgr.is_alarm_raised(), "Expected the alarm to be raised"
+    #[TEARDOWN]: AlarmManager quits alarm and stops the timer
+    alarm_mgr.quit_alarm()
+    alarm_mgr.stop_alarm_timer()
@@ -30,6 +30,10 @@ class ApplicationManager:
             self.state_mgr.log_emit("Entering main loop", self.__class__.__name__)
             while True:
                 idle()
+
+                # render requests left over when the schedule queue was full
+                self.state_mgr.display_process_render_requests()
+                self.state_mgr.neopixel_process_animation()
                 
                 if self.state_mgr.lowpower_is_lowpower_mode_active():
                     sleep(10)
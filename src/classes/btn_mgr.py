@@ -14,6 +14,7 @@ class ButtonManager:
         self.button_presses = {"green": 0, "blue": 0, "yellow": 0}
         self.last_time = {"green": 0, "blue": 0, "yellow": 0}
         self.debounce_time = debounce_time
+        self.handle_button_ref = self.handle_button # bound once, so the IRQ handler does not allocate
         
     def initialize(self):
         self.setup_interrupts()
@@ -58,14 +59,21 @@ class ButtonManager:
             button = "yellow"
         else:
             return
-        self.state_mgr.log_emit("Button pressed: " + button, self.__class__.__name__)
         if self.is_new_event(button, new_time_pressed):
-            if button == "green":
-                self.state_mgr.menu_press_green_button()
-            elif button == "blue":
-                self.state_mgr.menu_press_blue_button()
-            elif button == "yellow":
-                self.state_mgr.menu_press_yellow_button()
+            # menu handling draws on the display, keep that out of the IRQ handler
+            try:
+                micropython.schedule(self.handle_button_ref, button)
+            except RuntimeError:
+                pass # schedule queue is full, the press is dropped like a bounce
+
+    def handle_button(self, button):
+        self.state_mgr.log_emit("Button pressed: " + button, self.__class__.__name__)
+        if button == "green":
+            self.state_mgr.menu_press_green_button()
+        elif button == "blue":
+            self.state_mgr.menu_press_blue_button()
+        elif button == "yellow":
+            self.state_mgr.menu_press_yellow_button()
 
     @micropython.native
     def is_new_event(self, button, new_time_pressed):
@@ -119,6 +127,7 @@ def button_manager_runs():
     button_mgr.button_callback(button_mgr.get_green_button())
     button_mgr.button_callback(button_mgr.get_blue_button())
     button_mgr.button_callback(button_mgr.get_yellow_button())
+    sleep_ms(10) # let the scheduled handlers run
     #[THEN]: button presses are 1
     assert state_mgr.green_button_presses == 1, "Expected green button presses to be 1"
     assert state_mgr.blue_button_presses == 1, "Expected blue button presses to be 1"
@@ -1,14 +1,160 @@
 #inspiration from https://blog.martinfitzpatrick.com/displaying-images-oled-displays/
 
 import micropython
-from gc import collect, mem_free
+import struct
+from gc import collect, mem_free, mem_alloc
 from machine import I2C, Pin, RTC, Timer
-from utime import sleep
+from utime import sleep, ticks_ms, ticks_us, ticks_diff
 import framebuf
 import drivers.ssd1306 as ssd1306
 
+class AssetBundle:
+    # reads bitmaps from media/assets.bin, built from media/*.pbm by tools/pack_media.py
+    # the index (name -> offset, size, width, height) is read once, bitmaps are read on demand
+    MAGIC = b'PBMB'
+    HEADER_FORMAT = '<4sBBH'
+    HEADER_SIZE = 8
+    INDEX_FORMAT = '<10sBBHH'
+    INDEX_SIZE = 16
+
+    def __init__(self, file='media/assets.bin'):
+        self.file = file
+        self.index = {}
+
+    def initialize(self):
+        with open(self.file, 'rb') as f:
+            header = f.read(self.HEADER_SIZE)
+            magic, version, count, _ = struct.unpack(self.HEADER_FORMAT, header)
+            if magic != self.MAGIC:
+                raise ValueError('{} is not an asset bundle'.format(self.file))
+            index = f.read(self.INDEX_SIZE * count)
+        for i in range(count):
+            name, width, height, offset, size = struct.unpack_from(self.INDEX_FORMAT, index, i * self.INDEX_SIZE)
+            name = name.rstrip(b'\x00').decode()
+            self.index[name] = (offset, size, width, height)
+
+    def get_size(self, name):
+        entry = self.index[name]
+        return entry[2], entry[3]
+
+    def get_byte_size(self, name):
+        return self.index[name][1]
+
+    @micropython.native
+    def read_into(self, name, buf):
+        # fills a preallocated buffer, no allocation besides the file handle
+        offset, size, _, _ = self.index[name]
+        with open(self.file, 'rb') as f:
+            f.seek(offset)
+            f.readinto(memoryview(buf)[:size])
+        return buf
+
+    def load(self, name):
+        return self.read_into(name, bytearray(self.get_byte_size(name)))
+
+class GlyphCache:
+    # keeps ready-to-blit FrameBuffers in RAM, so redraws do not have to touch the filesystem
+    # pinned entries (digits, colon) are never evicted, the rest is evicted least recently used first
+    def __init__(self, bundle, max_entries=24, max_bytes=2048):
+        self.bundle = bundle
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = {} # name -> (fbuf, data)
+        self.order = [] # least recently used first
+        self.pinned = set()
+        self.bytes_used = 0
+        self.preload_mem_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @micropython.native
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry is not None:
+            self.hits += 1
+            if self.order[-1] != name:
+                self.order.remove(name)
+                self.order.append(name)
+            return entry[0]
+        self.misses += 1
+        return self.add(name)
+
+    @micropython.native
+    def get_pinned(self, name):
+        # pinned entries never move in the eviction order, so a hit is a plain lookup without allocation
+        entry = self.entries.get(name)
+        if entry is None or name not in self.pinned:
+            return self.get(name)
+        self.hits += 1
+        return entry[0]
+
+    def add(self, name):
+        width, height = self.bundle.get_size(name)
+        self.make_room(self.bundle.get_byte_size(name))
+        data = self.bundle.load(name)
+        fbuf = framebuf.FrameBuffer(data, width, height, framebuf.MONO_HLSB)
+        self.entries[name] = (fbuf, data)
+        self.order.append(name)
+        self.bytes_used += len(data)
+        return fbuf
+
+    def make_room(self, size):
+        while self.order and (len(self.entries) >= self.max_entries or self.bytes_used + size > self.max_bytes):
+            victim = None
+            for name in self.order:
+                if name not in self.pinned:
+                    victim = name
+                    break
+            if victim is None:
+                return # only pinned entries left, we go over budget rather than reload digits
+            self.evict(victim)
+
+    def evict(self, name):
+        entry = self.entries.pop(name)
+        self.order.remove(name)
+        self.bytes_used -= len(entry[1])
+        self.evictions += 1
+
+    def preload(self, names, pin=True):
+        collect()
+        mem_before = mem_free()
+        for name in names:
+            if name not in self.entries:
+                self.add(name)
+            if pin:
+                self.pinned.add(name)
+        collect()
+        self.preload_mem_used += mem_before - mem_free()
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0
+        return self.hits * 100 // lookups
+
+    def get_stats(self):
+        return {
+            'entries': len(self.entries),
+            'pinned': len(self.pinned),
+            'bytes': self.bytes_used,
+            'preload_mem': self.preload_mem_used,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.get_hit_rate(),
+        }
+
 @micropython.native
 class DisplayManager:
+    # render requests, timer callbacks only set these bits and the actual drawing happens later in scheduled or main loop context
+    RENDER_COMPOSE = 0x01
+    RENDER_BLINK = 0x02
+
+    GLYPH_NAMES = ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9')
+    CLOCK_RESYNC_INTERVAL = 600000 # ms, the clock face reads the RTC this often and counts ticks_ms in between
+    BATTERY_CHECK_INTERVAL = 300000 # ms, VSYS is sampled this often during compose, usb power on every compose
+
     def __init__(self, state_mgr, width=128, height=64):
         self.state_mgr = state_mgr
         self.i2c = I2C(0, scl=Pin(13), sda=Pin(12)) 
@@ -19,10 +165,50 @@ class DisplayManager:
         self.blinking_set_alarm_time_timer = None
         self.blinking_set_alarm_time_showing = False
         self.boot_messages = []
-
+        self.assets = AssetBundle()
+        self.assets.initialize()
+        self.glyph_cache = GlyphCache(self.assets)
+        self.frame_depth = 0 # > 0 while a frame is being composed
+        self.frame_dirty = False
+        # scratch buffers for the clock face, so rendering the time does not allocate
+        self.rtc = RTC()
+        self.time_chars = bytearray(b'00:00') # time to render
+        self.rendered_chars = bytearray(b'00:00') # time currently on the clock face
+        self.time_rendered = False
+        self.redrawn_cells = bytearray(5)
+        self.cell_x = bytearray(5)
+        self.layout_clock_face()
+        self.clock_anchor_ms = -1 # ms since midnight at clock_anchor_ticks, -1 until read from the RTC
+        self.clock_anchor_ticks = 0
+        self.battery_checked_ticks = 0
+        self.last_usb_powered = None # usb power when VSYS was last sampled
+        self.last_system_screen = None # system screen currently in the content area
+        self.last_battery_asset = None # battery bucket currently shown
+        self.last_state_asset = None # state region asset currently shown
+        self.region_renders = {'content': [0, 0], 'battery': [0, 0], 'state': [0, 0]} # rendered, skipped
+        self.render_requests = 0
+        self.render_scheduled = False
+        self.process_render_requests_ref = self.process_render_requests_scheduled # bound once, so requesting does not allocate
         
     def initialize(self):
         self.power_on()
+        self.preload_glyphs()
+
+    def preload_glyphs(self):
+        # digits and colon are needed on every redraw, load them once and keep them
+        self.glyph_cache.preload(['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'colon'])
+        self.log_glyph_cache_stats()
+
+    def get_glyph(self, name):
+        return self.glyph_cache.get(name)
+
+    def get_glyph_cache_stats(self):
+        return self.glyph_cache.get_stats()
+
+    def log_glyph_cache_stats(self):
+        stats = self.get_glyph_cache_stats()
+        self.state_mgr.log_emit("Glyph cache: {} entries, {} bytes bitmaps, {} bytes RAM preloaded, {}% hit rate ({} hits, {} misses, {} evictions)".format(
+            stats['entries'], stats['bytes'], stats['preload_mem'], stats['hit_rate'], stats['hits'], stats['misses'], stats['evictions']), self.__class__.__name__)
 
     def initialize_normal_operation(self):
         self.clear()
@@ -31,7 +217,7 @@ class DisplayManager:
     def start_update_display_timer(self):
         if self.update_display_timer is None:
             self.state_mgr.log_emit("Starting update display timer", self.__class__.__name__)
-            self.update_display_timer = Timer(period=60000, mode=Timer.PERIODIC, callback=lambda t: self.compose())
+            self.update_display_timer = Timer(period=60000, mode=Timer.PERIODIC, callback=lambda t: self.request_render(self.RENDER_COMPOSE))
 
     def stop_update_display_timer(self):
         if self.update_display_timer is not None:
@@ -43,7 +229,7 @@ class DisplayManager:
         self.blinking_set_alarm_time = True
         if self.blinking_set_alarm_time_timer is None:
             self.state_mgr.log_emit("Starting blinking set alarm time timer", self.__class__.__name__)
-            self.blinking_set_alarm_time_timer = Timer(period=300, mode=Timer.PERIODIC, callback=lambda t: self.blink_alarm_time())
+            self.blinking_set_alarm_time_timer = Timer(period=300, mode=Timer.PERIODIC, callback=lambda t: self.request_render(self.RENDER_BLINK))
 
     def stop_blinking_set_alarm_time(self):
         self.blinking_set_alarm_time = False
@@ -52,19 +238,93 @@ class DisplayManager:
             self.blinking_set_alarm_time_timer.deinit()
             self.blinking_set_alarm_time_timer = None
     
+    @micropython.native
+    def request_render(self, request):
+        # safe to call from timer callbacks: repeated requests coalesce into one pending bit
+        self.render_requests |= request
+        if not self.render_scheduled:
+            try:
+                micropython.schedule(self.process_render_requests_ref, None)
+                self.render_scheduled = True
+            except RuntimeError:
+                pass # schedule queue is full, the main loop will pick the request up
+
+    def process_render_requests_scheduled(self, _):
+        self.render_scheduled = False
+        self.process_render_requests()
+
+    @micropython.native
+    def process_render_requests(self):
+        requests = self.render_requests
+        if not requests:
+            return
+        self.render_requests = 0
+        if requests & self.RENDER_COMPOSE:
+            self.compose()
+        if requests & self.RENDER_BLINK and self.blinking_set_alarm_time:
+            self.blink_alarm_time()
+
+    def has_render_requests(self):
+        return self.render_requests != 0
+
     @micropython.native
     def blink_alarm_time(self):
+        # toggles between two cached images of the clock face pages, sent straight to the panel without drawing or diffing
         if self.blinking_set_alarm_time_showing:
-            self.clear_content_area()
+            self.display.write_region(self.clock_x0, self.clock_x1, self.clock_page0, self.clock_page1, self.blink_off_frame)
+            self.forget_rendered_time()
             self.blinking_set_alarm_time_showing = False
         else:
-            self.display_alarm_time()
+            alarm_time = self.state_mgr.alarm_get_alarm_time()
+            if alarm_time != self.blink_frame_time:
+                # alarm time changed (or first tick), render it the normal way and cache the result
+                self.display_alarm_time()
+                self.capture_blink_frame(alarm_time)
+            else:
+                self.display.write_region(self.clock_x0, self.clock_x1, self.clock_page0, self.clock_page1, self.blink_on_frame)
+                self.rendered_chars[:] = self.blink_frame_chars
+                self.time_rendered = True
             self.blinking_set_alarm_time_showing = True
 
+    def capture_blink_frame(self, alarm_time):
+        # copy the clock face pages out of the frame buffer, page by page as the panel expects them
+        buffer = self.display.buffer
+        width = self.display.width
+        span = self.clock_x1 - self.clock_x0 + 1
+        i = 0
+        for page in range(self.clock_page0, self.clock_page1 + 1):
+            offset = page * width + self.clock_x0
+            self.blink_on_frame[i:i + span] = buffer[offset:offset + span]
+            i += span
+        self.blink_frame_chars[:] = self.rendered_chars
+        self.blink_frame_time = alarm_time
+
+    def begin_frame(self):
+        # draw calls only go to the buffer until the matching end_frame()
+        self.frame_depth += 1
+
+    def end_frame(self):
+        if self.frame_depth > 0:
+            self.frame_depth -= 1
+        if self.frame_depth == 0 and self.frame_dirty:
+            self.frame_dirty = False
+            self.display.show()
+
+    @micropython.native
+    def show(self):
+        # inside a frame the push is deferred to end_frame(), outside it happens right away
+        if self.frame_depth > 0:
+            self.frame_dirty = True
+        else:
+            self.display.show()
+
     @micropython.native
     def clear(self):
         self.display.fill(0)
-        self.display.show()
+        self.forget_rendered_time()
+        self.last_system_screen = None
+        self.forget_first_row()
+        self.show()
 
     @micropython.native
     def display_text(self, text, x=0, y=0):
@@ -79,6 +339,7 @@ class DisplayManager:
 
     @micropython.native
     def load_image(self, file):
+        # legacy loader for a single pbm file, superseded by the asset bundle
         with open(file, 'rb') as f:
             f.readline()  # Magic number
             f.readline()  # Creator comment
@@ -88,130 +349,262 @@ class DisplayManager:
 
     @micropython.native
     def display_battery_state(self):
+        self.draw_battery_state(self.get_battery_asset())
+
+    @micropython.native
+    def get_battery_asset(self):
+        # the asset name doubles as the battery bucket: usb powered or charge in steps of 20%
         self.state_mgr.power_read_vsys()
         mains_powered = self.state_mgr.power_is_usb_powered()
         if not mains_powered:
             battery_percentage = self.state_mgr.power_get_battery_charge_percentage()
-        if mains_powered: file = 'media/bat_mains.pbm'
-        elif battery_percentage >=80: file = 'media/bat_100.pbm'
-        elif battery_percentage >=60 and battery_percentage <80: file = 'media/bat_080.pbm'
-        elif battery_percentage >=40 and battery_percentage <60: file = 'media/bat_060.pbm'
-        elif battery_percentage >=20 and battery_percentage <40: file = 'media/bat_040.pbm'
-        elif battery_percentage >0 and battery_percentage<20: file = 'media/bat_020.pbm'
-        else: file = 'media/bat_000.pbm'
-
-        data = self.load_image(file)
-        fbuf = framebuf.FrameBuffer(data, 20, 11, framebuf.MONO_HLSB)
-        self.display.blit(fbuf, 108, 0)
-        self.display.show()
+        if mains_powered: name = 'bat_mains'
+        elif battery_percentage >=80: name = 'bat_100'
+        elif battery_percentage >=60 and battery_percentage <80: name = 'bat_080'
+        elif battery_percentage >=40 and battery_percentage <60: name = 'bat_060'
+        elif battery_percentage >=20 and battery_percentage <40: name = 'bat_040'
+        elif battery_percentage >0 and battery_percentage<20: name = 'bat_020'
+        else: name = 'bat_000'
+        return name
+
+    @micropython.native
+    def draw_battery_state(self, name):
+        width, _ = self.assets.get_size(name)
+        self.display.blit(self.get_glyph(name), self.display.width - width, 0)
+        self.last_battery_asset = name
+        self.show()
 
     def get_time(self):
         # Get the current time
-        rtc = RTC()
-        return '{:02d}:{:02d}'.format(rtc.datetime()[4], rtc.datetime()[5])
-    
+        datetime = self.rtc.datetime()
+        return '{:02d}:{:02d}'.format(datetime[4], datetime[5])
+
+    def resync_clock(self):
+        # anchor the tick based clock face time to the RTC, call after the RTC was set
+        datetime = self.rtc.datetime()
+        self.clock_anchor_ticks = ticks_ms()
+        self.clock_anchor_ms = ((datetime[4] * 60 + datetime[5]) * 60 + datetime[6]) * 1000
+
     @micropython.native
-    def display_time(self, time):
-        # Split the time into hours and minutes
-        hours, minutes = time.split(':')
-    
-        # Define the starting position
+    def read_time_chars(self):
+        # fills self.time_chars with HH:MM without allocating, the RTC tuple is only read every CLOCK_RESYNC_INTERVAL
+        elapsed = ticks_diff(ticks_ms(), self.clock_anchor_ticks)
+        if self.clock_anchor_ms < 0 or elapsed < 0 or elapsed >= self.CLOCK_RESYNC_INTERVAL:
+            self.resync_clock()
+            elapsed = 0
+        minute_of_day = (self.clock_anchor_ms + elapsed) // 60000 % 1440
+        hours = minute_of_day // 60
+        minutes = minute_of_day % 60
+        chars = self.time_chars
+        chars[0] = 48 + hours // 10
+        chars[1] = 48 + hours % 10
+        chars[3] = 48 + minutes // 10
+        chars[4] = 48 + minutes % 10
+        return chars
+
+    def layout_clock_face(self):
+        # x position of each of the five cells, starting at 13 with one pixel between cells
+        digit_width, _ = self.assets.get_size('0')
+        colon_width, _ = self.assets.get_size('colon')
         x = 13
-        y = 26
+        for i in range(5):
+            self.cell_x[i] = x
+            x += (colon_width if i == 2 else digit_width) + 1
+        # the window the clock face occupies on the panel, used to blink it
+        _, digit_height = self.assets.get_size('0')
+        self.clock_x0 = self.cell_x[0]
+        self.clock_x1 = self.cell_x[4] + digit_width - 1
+        self.clock_page0 = 26 // 8
+        self.clock_page1 = (26 + digit_height - 1) // 8
+        size = (self.clock_x1 - self.clock_x0 + 1) * (self.clock_page1 - self.clock_page0 + 1)
+        self.blink_on_frame = bytearray(size)
+        self.blink_off_frame = bytearray(size)
+        self.blink_frame_chars = bytearray(5)
+        self.blink_frame_time = None # alarm time the cached blink frame shows
     
-        # For each digit in the time, draw it on the display
-        for i, digit in enumerate(hours + ':' + minutes):
-            if digit == ':':
-                file = 'media/colon.pbm'
-                width = 10
+    @micropython.native
+    def display_time(self, time):
+        # time as 'HH:MM'
+        chars = self.time_chars
+        for i in range(5):
+            chars[i] = ord(time[i])
+        self.render_time_chars()
+
+    @micropython.native
+    def render_time_chars(self):
+        # For each digit in self.time_chars that differs from what is on the display, draw it
+        # cells that did not change are neither blitted nor, thanks to the partial flush, sent to the panel
+        chars = self.time_chars
+        rendered = self.rendered_chars
+        redrawn = self.redrawn_cells
+        any_redrawn = False
+        for i in range(5):
+            code = chars[i]
+            if self.time_rendered and rendered[i] == code:
+                redrawn[i] = 0
+                continue
+            if code == 58: # ':'
+                fbuf = self.glyph_cache.get_pinned('colon')
             else:
-                file = f'media/{digit}.pbm'
-                width = 23
-            height = 24
-    
-            data = self.load_image(file)
-            fbuf = framebuf.FrameBuffer(data, width, height, framebuf.MONO_HLSB)
-            self.display.blit(fbuf, x, y)
-            x += width + 1
+                fbuf = self.glyph_cache.get_pinned(self.GLYPH_NAMES[code - 48])
+            self.display.blit(fbuf, self.cell_x[i], 26)
+            rendered[i] = code
+            redrawn[i] = 1
+            any_redrawn = True
     
-        self.display.show()
+        self.time_rendered = True
+        if any_redrawn:
+            self.show()
+
+    def get_redrawn_cells(self):
+        # cells touched by the last display_time()
+        return [i for i in range(5) if self.redrawn_cells[i]]
+
+    def forget_rendered_time(self):
+        # the clock face was drawn over, next display_time() has to redraw every cell
+        self.time_rendered = False
 
     @micropython.native
     def clear_content_area(self):
         self.display.fill_rect(0, 14, 128, 64-14, 0) # x start, y start, width, height        
-        self.display.show()
+        self.forget_rendered_time()
+        self.last_system_screen = None # the content area is empty, the next system screen has to be drawn
+        self.show()
 
     @micropython.native
     def display_state_region(self):
+        self.draw_state_region(self.get_state_region_asset())
+
+    @micropython.native
+    def get_state_region_asset(self):
         if self.state_mgr.menu_is_menu_active(): #menu beats alarm
-            file = 'media/settings.pbm'
-            data = self.load_image(file)
+            return 'settings'
         elif self.state_mgr.alarm_is_alarm_active(): #alarm beats idle
-            file = 'media/saber.pbm'
-            data = self.load_image(file)
-        else: #neither menu nor alarm active
-            data = bytearray(100 * 16)
-        
-        fbuf = framebuf.FrameBuffer(data, 100, 16, framebuf.MONO_HLSB)
-        self.display.blit(fbuf, 1, 1)
-        self.display.show()
+            return 'saber'
+        return 'blank' #neither menu nor alarm active
+
+    @micropython.native
+    def draw_state_region(self, name):
+        if name == 'blank':
+            self.display.fill_rect(1, 1, 100, 16, 0)
+        else:
+            self.display.blit(self.get_glyph(name), 1, 1)
+        self.last_state_asset = name
+        self.show()
         
     @micropython.native
     def display_input_voltage(self):
         self.state_mgr.power_read_vsys()
         voltage = round(self.state_mgr.power_get_vsys_voltage(),2)
         self.display_text(f'Vsys: {voltage}V', 0, 17)
-        self.display.show()
+        self.show()
 
     @micropython.native
     def display_available_memory(self):
         collect()
         available_memory = mem_free() / 1024
         self.display.text(f'Mem. free: {available_memory} kb', 0, 33)
-        self.display.show()
+        self.show()
 
     @micropython.native
     def display_board_temperature(self):
         self.state_mgr.power_read_temperature()
         temperature = self.state_mgr.power_get_temperature()
         self.display.text(f'B-Temp.: {temperature}C', 0, 49)
-        self.display.show()
+        self.show()
 
     @micropython.native
     def display_system_select(self):
         self.display.text('GREEN: shut down', 0, 17)
         self.display.text('BLUE: info', 0, 33)
         self.display.text('YELLOW: resume', 0, 49)
-        self.display.show()
+        self.show()
 
     @micropython.native
     def display_shutdown(self):
         self.display.text('Powering down...', 0, 33)
-        self.display.show()
+        self.show()
 
     @micropython.native
     def compose(self):
-        if self.state_mgr.menu_get_state() in ['idle', 'alarm_raised']:
-            self.display_time(self.get_time())
-        elif self.state_mgr.menu_get_state() == 'system':
-            self.clear_content_area()
-            if self.state_mgr.menu_get_system_state() == 'select':
-                self.state_mgr.log_emit("Displaying system select", self.__class__.__name__)
-                self.display_system_select()
-            elif self.state_mgr.menu_get_system_state() == 'info':
-                self.state_mgr.log_emit("Displaying system info", self.__class__.__name__)
-                self.display_input_voltage()
-                self.display_available_memory()
-                self.display_board_temperature()
-            elif self.state_mgr.menu_get_system_state() == 'shutdown':
-                self.state_mgr.log_emit("Displaying system shutdown", self.__class__.__name__)
-                self.display_shutdown()
+        self.begin_frame()
+        try:
+            self.compose_frame()
+        finally:
+            self.end_frame()
+
+    @micropython.native
+    def compose_frame(self):
+        # every region is keyed by what it shows, a region whose key did not change since it was drawn is skipped
+        menu_state = self.state_mgr.menu_get_state()
+        if menu_state == 'idle' or menu_state == 'alarm_raised':
+            chars = self.read_time_chars()
+            if self.time_rendered and chars == self.rendered_chars: # HH:MM
+                self.count_region_render('content', False)
+            else:
+                self.render_time_chars()
+                self.count_region_render('content', True)
+        elif menu_state == 'system':
+            system_state = self.state_mgr.menu_get_system_state()
+            if system_state == self.last_system_screen and system_state != 'info': # info shows live values
+                self.count_region_render('content', False)
+            else:
+                self.clear_content_area()
+                if system_state == 'select':
+                    self.state_mgr.log_emit("Displaying system select", self.__class__.__name__)
+                    self.display_system_select()
+                elif system_state == 'info':
+                    self.state_mgr.log_emit("Displaying system info", self.__class__.__name__)
+                    self.display_input_voltage()
+                    self.display_available_memory()
+                    self.display_board_temperature()
+                elif system_state == 'shutdown':
+                    self.state_mgr.log_emit("Displaying system shutdown", self.__class__.__name__)
+                    self.display_shutdown()
+                self.last_system_screen = system_state
+                self.count_region_render('content', True)
         if not self.state_mgr.alarm_is_alarm_raised():
-            self.display_battery_state()
-            self.display_state_region()
+            # battery bucket and usb power, VSYS is read again when usb power changes or every BATTERY_CHECK_INTERVAL
+            battery_asset = self.last_battery_asset
+            usb_powered = self.state_mgr.power_is_usb_powered()
+            now = ticks_ms()
+            if battery_asset is None or usb_powered != self.last_usb_powered or ticks_diff(now, self.battery_checked_ticks) >= self.BATTERY_CHECK_INTERVAL:
+                battery_asset = self.get_battery_asset()
+                self.battery_checked_ticks = now
+                self.last_usb_powered = usb_powered
+            if battery_asset == self.last_battery_asset:
+                self.count_region_render('battery', False)
+            else:
+                self.draw_battery_state(battery_asset)
+                self.count_region_render('battery', True)
+            state_asset = self.get_state_region_asset() # menu and alarm active
+            if state_asset == self.last_state_asset:
+                self.count_region_render('state', False)
+            else:
+                self.draw_state_region(state_asset)
+                self.count_region_render('state', True)
+
+    def count_region_render(self, region, rendered):
+        self.region_renders[region][0 if rendered else 1] += 1
+
+    def get_region_render_stats(self):
+        # region -> (rendered, skipped)
+        return {region: tuple(counts) for region, counts in self.region_renders.items()}
+
+    def forget_first_row(self):
+        self.last_battery_asset = None
+        self.last_state_asset = None
 
     @micropython.native
     def compose_boot(self, message):
+        self.begin_frame()
+        try:
+            self.compose_boot_frame(message)
+        finally:
+            self.end_frame()
+
+    @micropython.native
+    def compose_boot_frame(self, message):
         self.clear()
         self.display_text('Booting...', 0, 0)
         
@@ -220,7 +613,7 @@ class DisplayManager:
         for i, message in enumerate(self.boot_messages[-3:], start=1):
             self.display_text(message, 0, i*16)
     
-        self.display.show()
+        self.show()
 
     @micropython.native
     def display_alarm_time(self):
@@ -235,12 +628,13 @@ class DisplayManager:
         # Display the text from state_mgr.alarm_quit_button_sequence at the given index
         sequence_text = self.state_mgr.alarm_quit_button_sequence()[index]
         self.display.text(sequence_text, 0, 0)
-        self.display.show()
+        self.show()
 
     @micropython.native
     def clear_first_row(self):
         self.display.fill_rect(0, 0, 128, 16, 0)
-        self.display.show()
+        self.forget_first_row()
+        self.show()
         
     def deinit(self):
         self.stop_update_display_timer()
@@ -253,6 +647,7 @@ class MockStateManager:
     def __init__(self):
         self.menu_state = 'idle'
         self.menu_system_state = 'select'
+        self.usb_powered = False
 
     def log_emit(self, message, source):
         print(message)
@@ -279,13 +674,19 @@ class MockStateManager:
         pass
 
     def power_is_usb_powered(self):
-        return False
+        return self.usb_powered
     
     def power_get_battery_charge_percentage(self):
         return 80
     
     def power_get_vsys_voltage(self):
         return 3.2
+
+    def power_read_temperature(self):
+        pass
+
+    def power_get_temperature(self):
+        return 25.0
     
     def alarm_set_alarm_active(self, active):
         pass
@@ -465,6 +866,248 @@ def display_clears_content_area():
     #[TEARDOWN]
     display_mgr.deinit()
 
+def display_manager_reports_glyph_cache_stats():
+    #[GIVEN]: DisplayManager instance, glyphs preloaded
+    print("Test DisplayManager glyph cache")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    display_mgr.initialize()
+    misses_after_preload = display_mgr.get_glyph_cache_stats()['misses']
+    #[WHEN]: DisplayManager displays a number of times
+    for i in range(10):
+        display_mgr.forget_rendered_time()
+        display_mgr.display_time('{:02d}:{:02d}'.format(i, i))
+    #[THEN]: no digit had to be loaded from flash again
+    stats = display_mgr.get_glyph_cache_stats()
+    assert stats['misses'] == misses_after_preload, "Expected no glyph cache misses after preload"
+    assert stats['hits'] == 50, "Expected 50 glyph cache hits"
+    display_mgr.log_glyph_cache_stats()
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_compose_pushes_one_frame():
+    #[GIVEN]: DisplayManager instance
+    print("Test DisplayManager compose pushes one frame")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    #[WHEN]: DisplayManager composes the system info screen
+    state_mgr.menu_set_system_state('info')
+    state_mgr.menu_set_state('system')
+    shows_before = display_mgr.display.show_count
+    display_mgr.compose()
+    #[THEN]: the panel got exactly one push
+    assert display_mgr.display.show_count == shows_before + 1, "Expected exactly one show() per compose"
+    #[WHEN]: a helper is used outside of a frame
+    display_mgr.display_battery_state()
+    #[THEN]: it pushes on its own
+    assert display_mgr.display.show_count == shows_before + 2, "Expected helper to push outside of a frame"
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_benchmark_asset_loading():
+    #[GIVEN]: DisplayManager instance
+    print("Benchmark DisplayManager asset loading: pbm files vs. asset bundle")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    buf = bytearray(256)
+    print("{:<10} {:>10} {:>10} {:>10} {:>10}".format('asset', 'pbm us', 'pbm bytes', 'bundle us', 'bundle bytes'))
+    for name in sorted(display_mgr.assets.index):
+        #[WHEN]: the asset is loaded with load_image
+        collect()
+        alloc_before = mem_alloc()
+        start = ticks_us()
+        display_mgr.load_image('media/{}.pbm'.format(name))
+        pbm_us = ticks_diff(ticks_us(), start)
+        pbm_alloc = mem_alloc() - alloc_before
+        #[WHEN]: the asset is read from the bundle into a preallocated buffer
+        collect()
+        alloc_before = mem_alloc()
+        start = ticks_us()
+        display_mgr.assets.read_into(name, buf)
+        bundle_us = ticks_diff(ticks_us(), start)
+        bundle_alloc = mem_alloc() - alloc_before
+        #[THEN]: both return the same bitmap
+        size = display_mgr.assets.get_byte_size(name)
+        assert display_mgr.load_image('media/{}.pbm'.format(name)) == buf[:size], "Bundle differs from pbm for " + name
+        print("{:<10} {:>10} {:>10} {:>10} {:>10}".format(name, pbm_us, pbm_alloc, bundle_us, bundle_alloc))
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_time_redraws_only_changed_cells():
+    #[GIVEN]: DisplayManager instance, showing 09:59
+    print("Test DisplayManager display time redraws only changed cells")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    display_mgr.clear()
+    display_mgr.display_time('09:59')
+    assert display_mgr.get_redrawn_cells() == [0, 1, 2, 3, 4], "Expected all cells on first draw"
+    full_bytes = display_mgr.display.get_last_show_bytes()
+    #[WHEN]: the time goes to 10:00
+    display_mgr.display_time('10:00')
+    #[THEN]: all digits but not the colon are redrawn
+    assert display_mgr.get_redrawn_cells() == [0, 1, 3, 4], "Expected cells 0, 1, 3, 4 for 09:59 -> 10:00"
+    #[WHEN]: the time goes to 10:01
+    display_mgr.display_time('10:01')
+    #[THEN]: only the last digit is redrawn and sent
+    assert display_mgr.get_redrawn_cells() == [4], "Expected cell 4 for 10:00 -> 10:01"
+    print("All cells: {} bytes, last digit: {} bytes".format(full_bytes, display_mgr.display.get_last_show_bytes()))
+    #[WHEN]: the time goes from 23:59 to 00:00
+    display_mgr.display_time('23:59')
+    display_mgr.display_time('00:00')
+    #[THEN]: all digits but not the colon are redrawn
+    assert display_mgr.get_redrawn_cells() == [0, 1, 3, 4], "Expected cells 0, 1, 3, 4 for 23:59 -> 00:00"
+    #[WHEN]: the same time is displayed again
+    shows_before = display_mgr.display.show_count
+    display_mgr.display_time('00:00')
+    #[THEN]: nothing is redrawn or pushed
+    assert display_mgr.get_redrawn_cells() == [], "Expected no cells for an unchanged time"
+    assert display_mgr.display.show_count == shows_before, "Expected no push for an unchanged time"
+    #[WHEN]: the content area is cleared
+    display_mgr.clear_content_area()
+    display_mgr.display_time('00:00')
+    #[THEN]: all cells are redrawn
+    assert display_mgr.get_redrawn_cells() == [0, 1, 2, 3, 4], "Expected all cells after clearing the content area"
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_render_requests_coalesce():
+    #[GIVEN]: DisplayManager instance
+    print("Test DisplayManager render requests coalesce")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    shows_before = display_mgr.display.show_count
+    #[WHEN]: compose is requested several times before the requests are processed
+    display_mgr.render_scheduled = True # keep the scheduler out of it, we drain like the main loop does
+    for i in range(5):
+        display_mgr.request_render(display_mgr.RENDER_COMPOSE)
+    #[THEN]: nothing has been drawn yet
+    assert display_mgr.display.show_count == shows_before, "Expected no drawing while requesting"
+    #[WHEN]: the requests are processed
+    display_mgr.process_render_requests()
+    #[THEN]: one compose, one push
+    assert display_mgr.display.show_count == shows_before + 1, "Expected a single push for coalesced requests"
+    assert not display_mgr.has_render_requests(), "Expected no pending requests"
+    #[WHEN]: a blink is requested while not blinking
+    display_mgr.request_render(display_mgr.RENDER_BLINK)
+    display_mgr.process_render_requests()
+    #[THEN]: the stale blink is dropped
+    assert display_mgr.display.show_count == shows_before + 1, "Expected stale blink request to be dropped"
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_compose_skips_unchanged_regions():
+    #[GIVEN]: DisplayManager instance, composed once
+    print("Test DisplayManager compose skips unchanged regions")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    display_mgr.clear()
+    display_mgr.compose()
+    assert display_mgr.get_region_render_stats()['battery'] == (1, 0), "Expected battery to be drawn on first compose"
+    #[WHEN]: nothing visible changes over a few minute ticks
+    for i in range(5):
+        display_mgr.compose()
+    #[THEN]: battery and state region were skipped every time
+    stats = display_mgr.get_region_render_stats()
+    print("Region renders (rendered, skipped):", stats)
+    assert stats['battery'] == (1, 5), "Expected battery to be skipped"
+    assert stats['state'] == (1, 5), "Expected state region to be skipped"
+    #[WHEN]: the first row gets cleared, as when the alarm is quit
+    display_mgr.clear_first_row()
+    display_mgr.compose()
+    #[THEN]: battery and state region are drawn again
+    stats = display_mgr.get_region_render_stats()
+    assert stats['battery'] == (2, 5), "Expected battery to be drawn after clearing the first row"
+    assert stats['state'] == (2, 5), "Expected state region to be drawn after clearing the first row"
+    #[WHEN]: the charger is plugged in
+    state_mgr.usb_powered = True
+    display_mgr.compose()
+    #[THEN]: the battery region shows usb power on the next compose
+    assert display_mgr.last_battery_asset == 'bat_mains', "Expected the usb power icon right away"
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_forget_rendered_time_keeps_the_content_key():
+    #[GIVEN]: DisplayManager instance showing the system select screen
+    print("Test DisplayManager forget_rendered_time only resets the clock face")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    display_mgr.clear()
+    state_mgr.menu_state = 'system'
+    display_mgr.compose()
+    #[WHEN]: only the clock digits are forgotten
+    display_mgr.forget_rendered_time()
+    #[THEN]: the system screen is still known to be on the panel
+    assert display_mgr.last_system_screen == 'select', "Expected the content key to be kept"
+    #[WHEN]: the content area is cleared
+    display_mgr.clear_content_area()
+    #[THEN]: the system screen has to be drawn again
+    assert display_mgr.last_system_screen is None, "Expected the content key to be reset"
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_steady_state_compose_does_not_allocate():
+    #[GIVEN]: DisplayManager instance, composed through a full day of minute ticks to warm up the caches
+    print("Test DisplayManager steady state compose does not allocate")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    display_mgr.initialize()
+    display_mgr.clear()
+    display_mgr.compose()
+    ticks = 0
+    while ticks < 1440:
+        display_mgr.clock_anchor_ms = (display_mgr.clock_anchor_ms + 60000) % 86400000 # one minute later
+        display_mgr.compose()
+        ticks += 1
+    #[WHEN]: two more hours of minute ticks are composed
+    collect()
+    alloc_before = mem_alloc()
+    ticks = 0
+    while ticks < 120:
+        display_mgr.clock_anchor_ms = (display_mgr.clock_anchor_ms + 60000) % 86400000
+        display_mgr.compose()
+        ticks += 1
+    allocated = mem_alloc() - alloc_before
+    #[THEN]: nothing was allocated on the heap
+    print("Allocated during 120 composes: {} bytes".format(allocated))
+    assert allocated == 0, "Expected steady state compose not to allocate"
+    #[TEARDOWN]
+    display_mgr.deinit()
+
+def display_benchmark_blink_alarm_time():
+    #[GIVEN]: DisplayManager instance in alarm time setting mode
+    print("Benchmark DisplayManager blink alarm time: redraw vs. cached frames")
+    state_mgr = MockStateManager()
+    display_mgr = DisplayManager(state_mgr)
+    display_mgr.initialize()
+    display_mgr.clear()
+    display_mgr.blinking_set_alarm_time = True
+    ticks = 20
+    #[WHEN]: the alarm time blinks by clearing the content area and redrawing the digits
+    bytes_before = display_mgr.display.get_bytes_sent()
+    start = ticks_us()
+    for i in range(ticks):
+        if i % 2:
+            display_mgr.clear_content_area()
+        else:
+            display_mgr.display_alarm_time()
+    redraw_us = ticks_diff(ticks_us(), start) // ticks
+    redraw_bytes = (display_mgr.display.get_bytes_sent() - bytes_before) // ticks
+    #[WHEN]: the alarm time blinks from cached frames
+    display_mgr.clear()
+    display_mgr.blink_alarm_time() # first tick renders and caches the frame
+    display_mgr.blink_alarm_time()
+    bytes_before = display_mgr.display.get_bytes_sent()
+    start = ticks_us()
+    for i in range(ticks):
+        display_mgr.blink_alarm_time()
+    cached_us = ticks_diff(ticks_us(), start) // ticks
+    cached_bytes = (display_mgr.display.get_bytes_sent() - bytes_before) // ticks
+    #[THEN]: the cached frames are cheaper on the CPU and no heavier on the bus
+    print("per blink tick - redraw: {} us, {} bytes; cached: {} us, {} bytes".format(redraw_us, redraw_bytes, cached_us, cached_bytes))
+    assert cached_bytes <= redraw_bytes, "Expected cached blinking not to send more bytes than redrawing"
+    #[TEARDOWN]
+    display_mgr.deinit()
+
 def display_composes_boot():
     #[GIVEN]: DisplayManager instance
     print("Test DisplayManager compose boot")
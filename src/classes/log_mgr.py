@@ -2,6 +2,9 @@ import uos
 import utime
 
 class LogManager:
+    # the log is kept in two append-only segment files, the current one and the one before it
+    # once the current segment holds max_log_length lines it replaces the previous one and a new segment is started
+    # an emit appends one line, whatever the number of retained lines, nothing is rewritten in place
     def __init__(self, state_mgr):
         self.state_mgr = state_mgr
         self.verbose = True
@@ -9,6 +12,9 @@ class LogManager:
         self.max_log_length = 100
         self.log_file = 'log.txt'
         self.clean_log = False
+        self.log_handle = None
+        self.log_lines = 0 # lines in the current segment
+        self.bytes_written = 0
 
     def set_verbose(self, verbose):
         self.verbose = verbose
@@ -41,18 +47,51 @@ class LogManager:
         return self.clean_log
 
     def initialize(self):
-        # Check if the log file exists
+        self.close_log_file()
+        # If clean_log is True, delete both segments
+        if self.clean_log:
+            self.remove_log_files()
+        # The segments are only opened when logging is enabled
+        if self.log:
+            self.open_log_file()
+
+    def get_previous_log_file(self):
+        # log.txt -> log.1.txt
+        dot = self.log_file.rfind('.')
+        if dot < 0:
+            return self.log_file + '.1'
+        return self.log_file[:dot] + '.1' + self.log_file[dot:]
+
+    def open_log_file(self):
+        # Count the lines of the current segment once, then keep it open for appending
+        self.log_lines = 0
         if self.log_file in uos.listdir():
-            # If clean_log is True, delete the file
-            if self.clean_log:
-                uos.remove(self.log_file)
-                # Create the log file
-                with open(self.log_file, 'w') as f:
-                    pass
-        else:
-            # If the file doesn't exist, create it
-            with open(self.log_file, 'w') as f:
-                pass
+            with open(self.log_file, 'r') as f:
+                for _ in f:
+                    self.log_lines += 1
+        self.log_handle = open(self.log_file, 'a')
+
+    def close_log_file(self):
+        if self.log_handle is not None:
+            self.log_handle.close()
+            self.log_handle = None
+
+    def remove_log_files(self):
+        self.close_log_file()
+        files = uos.listdir()
+        for log_file in (self.log_file, self.get_previous_log_file()):
+            if log_file in files:
+                uos.remove(log_file)
+
+    def rotate_log_file(self):
+        # The full current segment becomes the previous one, renaming does not copy the file
+        self.close_log_file()
+        previous_log_file = self.get_previous_log_file()
+        if previous_log_file in uos.listdir():
+            uos.remove(previous_log_file)
+        uos.rename(self.log_file, previous_log_file)
+        self.log_handle = open(self.log_file, 'a')
+        self.log_lines = 0
     
     def emit(self, message, source_class):
         # Get the current time as a tuple
@@ -64,23 +103,37 @@ class LogManager:
         # If verbose is True, print the log entry
         if self.verbose:
             print(log_entry)
-        # If log is True, append the log entry to the file
+        # If log is True, append the log entry to the current segment
         if self.log:
-            with open(self.log_file, 'a') as f:
-                f.write(log_entry + '\n')
-            # Check the log size and remove the oldest message if necessary
-            self.check_log_size()
+            self.write_entry(log_entry)
 
-    def check_log_size(self):
-        with open(self.log_file, 'r') as f:
-            lines = f.readlines()
-        if len(lines) > self.max_log_length:
-            with open(self.log_file, 'w') as f:
-                for line in lines[-self.max_log_length:]:
-                    f.write(line)
+    def write_entry(self, log_entry):
+        if self.log_handle is None:
+            self.open_log_file()
+        if self.log_lines >= self.max_log_length:
+            self.rotate_log_file()
+        self.bytes_written += self.log_handle.write(log_entry + '\n')
+        self.log_handle.flush()
+        self.log_lines += 1
+
+    def read_log(self):
+        # Returns the last max_log_length entries, oldest first
+        if self.log_handle is not None:
+            self.log_handle.flush()
+        entries = []
+        files = uos.listdir()
+        for log_file in (self.get_previous_log_file(), self.log_file):
+            if log_file in files:
+                with open(log_file, 'r') as f:
+                    for line in f:
+                        entries.append(line.rstrip('\n'))
+        return entries[-self.max_log_length:]
+
+    def get_bytes_written(self):
+        return self.bytes_written
 
     def deinit(self):
-        pass
+        self.close_log_file()
 
 ## Mocks ##
 class MockStateManager:
@@ -90,6 +143,23 @@ class MockStateManager:
     def log_emit(self, message, source_class):
         pass
 
+class MockAppendLogManager(LogManager):
+    # the single log file as it was: append a line, then read all lines and rewrite the file if it grew too long
+    def initialize(self):
+        if self.clean_log or self.log_file not in uos.listdir():
+            with open(self.log_file, 'w') as f:
+                pass
+
+    def write_entry(self, log_entry):
+        with open(self.log_file, 'a') as f:
+            self.bytes_written += f.write(log_entry + '\n')
+        with open(self.log_file, 'r') as f:
+            lines = f.readlines()
+        if len(lines) > self.max_log_length:
+            with open(self.log_file, 'w') as f:
+                for line in lines[-self.max_log_length:]:
+                    self.bytes_written += f.write(line)
+
 ## Test ##
 def log_manager_emits_messages():
     #[GIVEN]: A LogManager instance, set up to print but not log
@@ -105,8 +175,10 @@ def log_manager_emits_messages():
     log_mgr.emit('Test message', 'TestClass')
     #[THEN]: The message is printed
     # The output is the message
+    #[THEN]: No log file is created while logging is off
+    assert 'test_log.txt' not in uos.listdir(), "Expected no log file"
     #[TEARDOWN]: Clean up the log file
-    uos.remove('test_log.txt')
+    log_mgr.remove_log_files()
 
 def log_manager_logs_messages():
     #[GIVEN]: A LogManager instance, set up to log but not print
@@ -122,11 +194,10 @@ def log_manager_logs_messages():
     log_mgr.emit('Test message', 'TestClass')
     #[THEN]: The message is logged
     # The log file contains the message
-    print('load the log file and print() its contents')
-    with open('test_log.txt', 'r') as f:
-        print(f.read())    
+    entries = log_mgr.read_log()
+    assert len(entries) == 1 and entries[0].endswith('TestClass: Test message'), "Expected the message in the log, got {}".format(entries)
     #[TEARDOWN]: Clean up the log file
-    uos.remove('test_log.txt')
+    log_mgr.remove_log_files()
 
 def log_manager_limits_log_size():
     #[GIVEN]: A LogManager instance, set up to log but not print
@@ -136,14 +207,61 @@ def log_manager_limits_log_size():
     log_mgr.set_log(True)
     log_mgr.set_max_log_length(5)
     log_mgr.set_log_file('test_log.txt')
+    log_mgr.set_clean_log(True)
     log_mgr.initialize()
     #[WHEN]: We emit more messages than the log can hold
     for i in range(10):
         log_mgr.emit('Test message {}'.format(i), 'TestClass')
     #[THEN]: The log contains only the most recent messages
-    # The log file contains the last 5 messages
-    print('load the log file and print() its contents')
-    with open('test_log.txt', 'r') as f:
-        print(f.read())    
-    #[TEARDOWN]: Clean up the log file
-    uos.remove('test_log.txt')
\ No newline at end of file
+    # The log file contains the last 5 messages, oldest first
+    entries = log_mgr.read_log()
+    assert [entry.split(': ')[-1] for entry in entries] == ['Test message {}'.format(i) for i in range(5, 10)], "Expected the last 5 messages, got {}".format(entries)
+    #[THEN]: No segment holds more than max_log_length lines
+    for log_file in ('test_log.txt', 'test_log.1.txt'):
+        with open(log_file, 'r') as f:
+            assert len(f.readlines()) <= 5, "Expected at most 5 lines in {}".format(log_file)
+    #[WHEN]: The log is opened again and one more message is emitted
+    log_mgr.deinit()
+    log_mgr = LogManager(state_mgr)
+    log_mgr.set_verbose(False)
+    log_mgr.set_log(True)
+    log_mgr.set_max_log_length(5)
+    log_mgr.set_log_file('test_log.txt')
+    log_mgr.initialize()
+    log_mgr.emit('Test message 10', 'TestClass')
+    #[THEN]: The log continues where it stopped
+    entries = log_mgr.read_log()
+    assert entries[0].endswith('Test message 6') and entries[-1].endswith('Test message 10'), "Expected the log to continue, got {}".format(entries)
+    #[TEARDOWN]: Clean up the log files
+    log_mgr.remove_log_files()
+
+def benchmark_log_emit(line_counts=(100, 1000, 10000), rounds=20):
+    #[GIVEN]: Full logs of the single file and the segment kind, for each number of retained lines
+    state_mgr = MockStateManager()
+    for count in line_counts:
+        results = []
+        for log_class in (MockAppendLogManager, LogManager):
+            log_mgr = log_class(state_mgr)
+            log_mgr.set_verbose(False)
+            log_mgr.set_log(True)
+            log_mgr.set_max_log_length(count)
+            log_mgr.set_log_file('test_log.txt')
+            log_mgr.set_clean_log(True)
+            log_mgr.initialize()
+            if log_class is MockAppendLogManager:
+                with open('test_log.txt', 'w') as f:
+                    for i in range(count):
+                        f.write('2024-01-01-00-00-00: TestClass: Filler message {}\n'.format(i))
+            else:
+                for i in range(count):
+                    log_mgr.emit('Filler message {}'.format(i), 'TestClass')
+            #[WHEN]: More messages are emitted, the first one rotates the full segment
+            log_mgr.bytes_written = 0
+            start = utime.ticks_us()
+            for i in range(rounds):
+                log_mgr.emit('Test message {}'.format(i), 'TestClass')
+            results.append((utime.ticks_diff(utime.ticks_us(), start) / rounds, log_mgr.get_bytes_written() / rounds))
+            #[TEARDOWN]: Clean up the log files
+            log_mgr.remove_log_files()
+        #[THEN]: We can compare the time and the bytes written to flash per emit
+        print("{} lines: single file {:.0f} us {:.0f} bytes, segments {:.0f} us {:.0f} bytes per emit".format(count, results[0][0], results[0][1], results[1][0], results[1][1]))
\ No newline at end of file
@@ -4,11 +4,92 @@ from random import randint
 from machine import Pin, Timer
 import neopixel
 
+# region buffer kernels
+# work on the strip buffer bytes in place, pixels are already in the strip's wire order
+@micropython.viper
+def fill_pixels(buf, pixel, start: int, count: int):
+    # writes the bpp bytes of pixel into count pixels from start
+    dst = ptr8(buf)
+    src = ptr8(pixel)
+    bpp = int(len(pixel))
+    i = start * bpp
+    end = i + count * bpp
+    while i < end:
+        for j in range(bpp):
+            dst[i + j] = src[j]
+        i += bpp
+
+@micropython.viper
+def blit_pixels(buf, frame):
+    # copies a prepared frame of the same size into the buffer
+    dst = ptr8(buf)
+    src = ptr8(frame)
+    for i in range(int(len(buf))):
+        dst[i] = src[i]
+
+@micropython.viper
+def rotate_pixels(buf, bpp: int, forward: bool):
+    # moves every pixel one position along the ring, the one falling off the end comes back in at the other
+    p = ptr8(buf)
+    size = int(len(buf))
+    for _ in range(bpp):
+        if forward:
+            last = p[size - 1]
+            i = size - 1
+            while i > 0:
+                p[i] = p[i - 1]
+                i -= 1
+            p[0] = last
+        else:
+            first = p[0]
+            i = 0
+            while i < size - 1:
+                p[i] = p[i + 1]
+                i += 1
+            p[size - 1] = first
+# endregion
+
 class NeoPixelManager:
+    # brightness levels used by the effects, their lookup tables are built up front, any other level is built on first use
+    BRIGHTNESS_LEVELS = (0.01, 0.05, 0.1, 0.2, 1.0)
+    GAMMA = 2.2
+    # sunrise from deep red to warm white: (progress 0..1000, red, green, blue, perceived level 0..255)
+    # compiled once into SUNRISE_STEPS + 1 gamma corrected colors and interpolated between them in fixed point
+    SUNRISE_KEYFRAMES = (
+        (0, 255, 0, 0, 48),
+        (250, 255, 60, 0, 110),
+        (500, 255, 130, 30, 170),
+        (750, 255, 190, 100, 220),
+        (1000, 255, 221, 148, 255),
+    )
+    SUNRISE_STEPS = 64
+    SUNRISE_FPS = 25
+    SUNRISE_BRIGHTNESS = 0.2
+
     def __init__(self, state_mgr, ledCount=16, ctrlPin=28):
         self.np = neopixel.NeoPixel(pin=Pin(ctrlPin), n=ledCount)
         self.state_mgr = state_mgr
         self.update_analog_clock_timer = None
+        self.frame_tables = {} # (effect, colors) -> (table, memoryview per frame), compiled once
+        # animations are generators that draw one frame per step and yield the delay in ms until the next one
+        # a one shot timer schedules each step, so nothing blocks and an animation can be dropped between any two frames
+        self.animation = None
+        self.animation_timer = None
+        self.animation_step_pending = False
+        self.animation_timer_callback_ref = self.animation_timer_callback # bound once, so re-arming does not allocate
+        self.step_animation_scheduled_ref = self.step_animation_scheduled
+        # 256 entry lookup tables, channel value -> scaled channel value, so colors are computed with integer lookups only
+        self.gamma_lut = bytearray(round(255 * (v / 255) ** self.GAMMA) for v in range(256))
+        self.brightness_luts = {}
+        self.gamma_brightness_luts = {}
+        for brightness in self.BRIGHTNESS_LEVELS:
+            self.get_brightness_lut(brightness)
+            self.get_brightness_lut(brightness, True)
+        # analog clock, the hands drawn last time, so the ring is only rewritten when one of them moves
+        self.clock_color_tables = {} # brightness -> color per combination of hands sharing an led
+        self.forget_analog_clock()
+        self.sunrise_table = None
+        self.pixel = bytearray(self.np.bpp) # scratch pixel in wire order, so filling does not allocate
         
     def initialize(self):
         self.all_off()
@@ -30,93 +111,243 @@ class NeoPixelManager:
 
     @micropython.native
     def all_off(self):
-        self.np.fill((0, 0, 0))
+        self.stop_animation()
+        self.forget_analog_clock()
+        self.fill((0, 0, 0))
         self.np.write()
         sleep(.1) # neopixel needs some time to turn off
 
+    def get_brightness_lut(self, brightness, gamma=False):
+        # same truncation as scaling by the float brightness, with gamma the channel is gamma corrected before scaling
+        luts = self.gamma_brightness_luts if gamma else self.brightness_luts
+        lut = luts.get(brightness)
+        if lut is None:
+            if gamma:
+                lut = bytearray(int(self.gamma_lut[v] * brightness) for v in range(256))
+            else:
+                lut = bytearray(int(v * brightness) for v in range(256))
+            luts[brightness] = lut
+        return lut
+
     @micropython.native
-    def get_color(self, red=0, green=0, blue=0, brightness=0.2):
-        return (int(red * brightness), int(green * brightness), int(blue * brightness))
+    def get_color(self, red=0, green=0, blue=0, brightness=0.2, gamma=False):
+        # channels are ints 0..255
+        lut = self.get_brightness_lut(brightness, gamma)
+        return (lut[red], lut[green], lut[blue])
 
     @micropython.native
     def all_on(self, color):
-        self.np.fill(color)
+        self.fill(color)
         self.np.write()
 
     @micropython.native
     def single_on(self, color, ledIndex):
-        self.np[ledIndex] = color
+        self.fill(color, ledIndex % self.np.n, 1)
         self.np.write()
 
-    def get_now(self):
-        return gmtime(time())
+    # region direct buffer access
+    # these change the strip buffer in place, nothing is sent until np.write()
+    def get_buffer(self):
+        return memoryview(self.np.buf)
+
+    def encode_pixel(self, color):
+        # returns the scratch pixel, valid until the next call
+        self.encode_color(self.pixel, 0, color)
+        return self.pixel
 
     @micropython.native
-    def pendulum(self, colors, delay=0.1, loops=3):
-        while loops > 0:
-            if not self.state_mgr.alarm_is_alarm_raised():
-                break
-            for i in range(self.np.n):
-                for j, color in enumerate(colors):
-                    self.np[(i+j)%self.np.n] = color
-                self.np.write()
-                sleep(delay)
-                for j in range(len(colors)):
-                    self.np[(i+j)%self.np.n] = (0, 0, 0)
-            for i in range(self.np.n-1, -1, -1):
-                for j, color in enumerate(colors):
-                    self.np[(i+j)%self.np.n] = color
-                self.np.write()
-                sleep(delay)
-                for j in range(len(colors)):
-                    self.np[(i+j)%self.np.n] = (0, 0, 0)
-            loops -= 1
+    def fill(self, color, start=0, count=-1):
+        if count < 0:
+            count = self.np.n - start
+        fill_pixels(self.np.buf, self.encode_pixel(color), start, count)
 
     @micropython.native
-    def chase(self, colors, delay=0.1, loops=3):
-        while loops > 0:
-            if not self.state_mgr.alarm_is_alarm_raised():
-                break
-            for i in range(self.np.n):
-                for j, color in enumerate(colors):
-                    self.np[(i+j)%self.np.n] = color
-                self.np.write()
-                sleep(delay)
-                self.np[i] = (0, 0, 0)
-            loops -= 1
+    def blit(self, frame):
+        blit_pixels(self.np.buf, frame)
 
     @micropython.native
-    def turning_wheel(self, color, delay=0.1, loops=3):
-        for i in range(self.np.n):
-            if i % 2 == 0:
-                self.np[i] = color
-            else:
-                self.np[i] = (0, 0, 0)
+    def rotate(self, forward=True):
+        rotate_pixels(self.np.buf, self.np.bpp, forward)
+    # endregion
+
+    def get_now(self):
+        return gmtime(time())
+
+    # region frame tables
+    # effects are compiled once into one contiguous bytearray of frames, each frame already in the strip's wire order
+    # playing a frame is a plain copy into the NeoPixel buffer
+    def encode_color(self, frame, offset, color):
+        # same channel mapping as NeoPixel.__setitem__: channel i of the color goes to byte ORDER[i] of the pixel
+        order = self.np.ORDER
+        for i in range(self.np.bpp):
+            frame[offset + order[i]] = color[i]
+
+    def compile_frames(self, frames):
+        # frames: list of frames, each a list of (led index, color), leds not listed are off
+        size = self.np.n * self.np.bpp
+        table = bytearray(size * len(frames))
+        for k, pixels in enumerate(frames):
+            for index, color in pixels:
+                self.encode_color(table, k * size + index * self.np.bpp, color)
+        view = memoryview(table)
+        return table, [view[k * size:(k + 1) * size] for k in range(len(frames))]
+
+    def compile_window(self, colors, start):
+        # colors laid out on consecutive leds from start, wrapping around the ring
+        return [((start + j) % self.np.n, color) for j, color in enumerate(colors)]
+
+    def compile_pendulum(self, colors):
+        starts = list(range(self.np.n)) + list(range(self.np.n - 1, -1, -1))
+        return self.compile_frames([self.compile_window(colors, i) for i in starts])
+
+    def compile_chase(self, colors):
+        # the following frames are this one rotated along the ring
+        return self.compile_frames([self.compile_window(colors, 0)])
+
+    def compile_turning_wheel(self, color):
+        # the other frame is this one rotated by one led
+        return self.compile_frames([[(i, color) for i in range(0, self.np.n, 2)]])
+
+    def get_frame_table(self, effect, colors):
+        key = (effect, tuple(colors))
+        table = self.frame_tables.get(key)
+        if table is None:
+            if effect == 'pendulum':
+                table = self.compile_pendulum(colors)
+            elif effect == 'chase':
+                table = self.compile_chase(colors)
+            elif effect == 'turning_wheel':
+                table = self.compile_turning_wheel(colors)
+            self.frame_tables[key] = table
+        return table[1]
+
+    @micropython.native
+    def show_frame(self, frame):
+        self.blit(frame)
         self.np.write()
-        sleep(delay)
+    # endregion
+
+    # region animation engine
+    def start_animation(self, animation):
+        self.stop_animation()
+        self.forget_analog_clock()
+        self.animation = animation
+        self.step_animation()
+
+    def stop_animation(self):
+        if self.animation_timer is not None:
+            self.animation_timer.deinit()
+        self.animation_step_pending = False
+        animation = self.animation
+        self.animation = None
+        if animation is not None:
+            try:
+                animation.close()
+            except ValueError:
+                pass # stopped from within its own step, it is dropped all the same
+
+    def is_animation_running(self):
+        return self.animation is not None
+
+    def step_animation(self):
+        self.animation_step_pending = False
+        animation = self.animation
+        if animation is None:
+            return
+        try:
+            delay = next(animation)
+        except StopIteration:
+            if self.animation is animation:
+                self.animation = None
+            return
+        if self.animation is not animation:
+            return # stopped or replaced while drawing the frame
+        if self.animation_timer is None:
+            self.animation_timer = Timer()
+        self.animation_timer.init(mode=Timer.ONE_SHOT, period=max(1, delay), callback=self.animation_timer_callback_ref)
+
+    def animation_timer_callback(self, _):
+        try:
+            micropython.schedule(self.step_animation_scheduled_ref, None)
+        except RuntimeError:
+            self.animation_step_pending = True # schedule queue is full, the main loop will take the step
+
+    def step_animation_scheduled(self, _):
+        self.step_animation()
+
+    def process_animation(self):
+        if self.animation_step_pending:
+            self.step_animation()
+
+    def off_animation(self):
+        self.fill((0, 0, 0))
+        self.np.write()
+        yield 100 # neopixel needs some time to turn off
+
+    def pendulum_animation(self, colors, delay=0.1, loops=3):
+        frames = self.get_frame_table('pendulum', colors)
+        delay_ms = int(delay * 1000)
         for _ in range(loops):
-            if not self.state_mgr.alarm_is_alarm_raised():
-                break
-            for i in range(self.np.n):
-                if i % 2 == 0:
-                    self.np[i] = (0, 0, 0)
-                else:
-                    self.np[i] = color
+            for frame in frames:
+                self.show_frame(frame)
+                yield delay_ms
+
+    def chase_animation(self, colors, delay=0.1, loops=3):
+        frames = self.get_frame_table('chase', colors)
+        delay_ms = int(delay * 1000)
+        self.show_frame(frames[0])
+        yield delay_ms
+        for _ in range(loops * self.np.n - 1):
+            self.rotate()
             self.np.write()
-            sleep(delay)
-            for i in range(self.np.n):
-                if i % 2 == 0:
-                    self.np[i] = color
-                else:
-                    self.np[i] = (0, 0, 0)
+            yield delay_ms
+
+    def turning_wheel_animation(self, color, delay=0.1, loops=3):
+        frames = self.get_frame_table('turning_wheel', color)
+        delay_ms = int(delay * 1000)
+        self.show_frame(frames[0])
+        yield delay_ms
+        for _ in range(2 * loops):
+            self.rotate()
             self.np.write()
-            sleep(delay)
+            yield delay_ms
+    # endregion
+
+    def pendulum(self, colors, delay=0.1, loops=3):
+        self.start_animation(self.pendulum_animation(colors, delay, loops))
+
+    def chase(self, colors, delay=0.1, loops=3):
+        self.start_animation(self.chase_animation(colors, delay, loops))
+
+    def turning_wheel(self, color, delay=0.1, loops=3):
+        self.start_animation(self.turning_wheel_animation(color, delay, loops))
+
+    def get_clock_colors(self, brightness):
+        # index is a bit mask of the hands on an led: 1 hour (red), 2 minute (green), 4 second (blue)
+        # hands sharing an led are shown in their mixed color
+        table = self.clock_color_tables.get(brightness)
+        if table is None:
+            hands = (self.get_color(255, 0, 0, brightness), self.get_color(0, 255, 0, brightness), self.get_color(0, 0, 255, brightness))
+            table = []
+            for mask in range(8):
+                members = [hands[i] for i in range(3) if mask & (1 << i)]
+                if members:
+                    table.append(tuple(sum(color[channel] for color in members) // len(members) for channel in range(3)))
+                else:
+                    table.append((0, 0, 0))
+            self.clock_color_tables[brightness] = table
+        return table
+
+    def forget_analog_clock(self):
+        # the ring was drawn by something else, the next analog_clock redraws it completely
+        self.clock_colors = None
+        self.clock_hour_index = -1
+        self.clock_minute_index = -1
+        self.clock_second_index = -1
 
     @micropython.native
     def analog_clock(self, brightness=0.05):
-        hour_color = self.get_color(255, 0, 0, brightness)  # Red
-        minute_color = self.get_color(0, 255, 0, brightness)  # Green
-        second_color = self.get_color(0, 0, 255, brightness)  # Blue
+        colors = self.get_clock_colors(brightness)
         
         # Get the current time
         loc_time = self.get_now()
@@ -126,76 +357,115 @@ class NeoPixelManager:
 
         # Calculate the LED indices for each hand
         # the hour hand will deliberately be dragging behind since we choose to not account for minutes passed in the hour
-        hour_index = int(hour / 12 * self.np.n) - int(self.np.n / 2)
-        minute_index = int(minute / 60 * self.np.n) - int(self.np.n / 2)
-        second_index = int(second / 60 * self.np.n) - int(self.np.n / 2)
-        
-        self.np.fill((0, 0, 0))
-        
-        # if hourIndex, minuteIndex, secondIndex are the same in some combo, the color will be mixed
-        # this is a stupid way to do it, but it works
-        if hour_index == minute_index == second_index:
-            # all hands are on the same LED
-            mix_color = (int((hour_color[0] + minute_color[0] + second_color[0]) / 3), int((hour_color[1] + minute_color[1] + second_color[1]) / 3), int((hour_color[2] + minute_color[2] + second_color[2]) / 3))
-            self.single_on(mix_color, hour_index)
-        elif hour_index == minute_index:
-            # hour and minute hands are on the same LED
-            mix_color = (int((hour_color[0] + minute_color[0]) / 2), int((hour_color[1] + minute_color[1]) / 2), int((hour_color[2] + minute_color[2]) / 2))
-            self.single_on(mix_color, hour_index)
-            self.single_on(second_color, second_index)
-        elif hour_index == second_index:
-            # hour and second hands are on the same LED
-            mix_color = (int((hour_color[0] + second_color[0]) / 2), int((hour_color[1] + second_color[1]) / 2), int((hour_color[2] + second_color[2]) / 2))
-            self.single_on(mix_color, hour_index)
-            self.single_on(minute_color, minute_index)
-        elif minute_index == second_index:
-            # minute and second hands are on the same LED
-            mix_color = (int((minute_color[0] + second_color[0]) / 2), int((minute_color[1] + second_color[1]) / 2), int((minute_color[2] + second_color[2]) / 2))
-            self.single_on(mix_color, minute_index)
-            self.single_on(hour_color, hour_index)
-        else:    
-            # no hands are on the same LED
-            self.single_on(hour_color, hour_index)
-            self.single_on(minute_color, minute_index)
-            self.single_on(second_color, second_index)
-        
+        n = self.np.n
+        hour_index = (hour * n // 12 - n // 2) % n
+        minute_index = (minute * n // 60 - n // 2) % n
+        second_index = (second * n // 60 - n // 2) % n
+
+        if colors is self.clock_colors and hour_index == self.clock_hour_index and minute_index == self.clock_minute_index and second_index == self.clock_second_index:
+            return False # no hand moved, nothing to write
+
+        # switch off the hands drawn last time, the whole ring if we do not know what is on it
+        if self.clock_colors is None:
+            self.fill(colors[0])
+        else:
+            self.fill(colors[0], self.clock_hour_index, 1)
+            self.fill(colors[0], self.clock_minute_index, 1)
+            self.fill(colors[0], self.clock_second_index, 1)
+
+        self.fill(colors[1 | (2 if minute_index == hour_index else 0) | (4 if second_index == hour_index else 0)], hour_index, 1)
+        self.fill(colors[2 | (1 if hour_index == minute_index else 0) | (4 if second_index == minute_index else 0)], minute_index, 1)
+        self.fill(colors[4 | (1 if hour_index == second_index else 0) | (2 if minute_index == second_index else 0)], second_index, 1)
         self.np.write()
 
+        self.clock_colors = colors
+        self.clock_hour_index = hour_index
+        self.clock_minute_index = minute_index
+        self.clock_second_index = second_index
+        return True
+
+    def sunrise(self, duration=None, fps=None):
+        self.start_animation(self.sunrise_animation(duration, fps))
+
+    def compile_sunrise(self):
+        # float math happens here once, playback only interpolates between neighbouring steps
+        lut = self.get_brightness_lut(self.SUNRISE_BRIGHTNESS)
+        keys = self.SUNRISE_KEYFRAMES
+        table = bytearray(3 * (self.SUNRISE_STEPS + 1))
+        k = 0
+        for step in range(self.SUNRISE_STEPS + 1):
+            progress = step * 1000 // self.SUNRISE_STEPS
+            while keys[k + 1][0] < progress:
+                k += 1
+            p0, r0, g0, b0, l0 = keys[k]
+            p1, r1, g1, b1, l1 = keys[k + 1]
+            f = (progress - p0) / (p1 - p0)
+            level = self.gamma_lut[int(l0 + (l1 - l0) * f)]
+            table[3 * step] = lut[int((r0 + (r1 - r0) * f) * level / 255)]
+            table[3 * step + 1] = lut[int((g0 + (g1 - g0) * f) * level / 255)]
+            table[3 * step + 2] = lut[int((b0 + (b1 - b0) * f) * level / 255)]
+        return table
+
+    @micropython.native
+    def draw_sunrise_frame(self, table, position, count):
+        # position: progress in steps with 8 fractional bits, count: leds lit from the start of the ring
+        step = position >> 8
+        frac = position & 0xFF
+        a = 3 * step
+        b = a + 3 if step < self.SUNRISE_STEPS else a
+        pixel = self.pixel
+        order = self.np.ORDER
+        pixel[order[0]] = table[a] + (((table[b] - table[a]) * frac) >> 8)
+        pixel[order[1]] = table[a + 1] + (((table[b + 1] - table[a + 1]) * frac) >> 8)
+        pixel[order[2]] = table[a + 2] + (((table[b + 2] - table[a + 2]) * frac) >> 8)
+        # the lit leds always share one color and the newest one was dark before, so it tells whether anything changes
+        buf = self.np.buf
+        offset = (count - 1) * self.np.bpp
+        if buf[offset] == pixel[0] and buf[offset + 1] == pixel[1] and buf[offset + 2] == pixel[2]:
+            return False
+        fill_pixels(buf, pixel, 0, count)
+        return True
+
     @micropython.native
-    def sunrise(self, duration=None):
-        start_color = self.get_color(255, 0, 0)  # Red
-        end_color = self.get_color(255, 221, 148)  # Warm white
-        start_brightness = 0.1  # Very low brightness
-        end_brightness = 1.0  # Full brightness
+    def draw_sunrise_at(self, table, elapsed_ms, duration_ms, ms_per_step):
+        # progress in steps with 8 fractional bits, the lit part of the ring grows along with it
+        # both stay small ints for a sunrise of up to an hour, so a frame does not allocate
+        position = (elapsed_ms << 8) // ms_per_step
+        last_position = self.SUNRISE_STEPS << 8
+        if position > last_position:
+            position = last_position
+        n = self.np.n
+        count = elapsed_ms * n // duration_ms + 1
+        if count > n:
+            count = n
+        # frames that come out the same as the last one are not written, which is most of them at low brightness
+        if self.draw_sunrise_frame(table, position, count):
+            self.np.write()
+
+    def sunrise_animation(self, duration=None, fps=None):
+        if self.sunrise_table is None:
+            self.sunrise_table = self.compile_sunrise()
+        table = self.sunrise_table
         if duration is None:
             duration = 300  # 5 minutes
+        if fps is None:
+            fps = self.SUNRISE_FPS
+        frame_ms = 1000 // fps
+        duration_ms = duration * 1000
+        ms_per_step = duration_ms // self.SUNRISE_STEPS
         start_time = ticks_ms()
 
         while True:
-            if not self.state_mgr.alarm_is_alarm_raised():
-                break
-            elapsed_time = ticks_diff(ticks_ms(), start_time) / 1000  # Convert to seconds
-            if elapsed_time > duration:
+            elapsed_ms = ticks_diff(ticks_ms(), start_time)
+            if elapsed_ms > duration_ms:
                 break        
 
-            # Calculate the current brightness and color based on the elapsed time
-            t = elapsed_time / duration  # t goes from 0 to 1 over the duration
-            current_brightness = start_brightness + t * (end_brightness - start_brightness)
-            current_color = (
-                int(start_color[0] + t * (end_color[0] - start_color[0])),
-                int(start_color[1] + t * (end_color[1] - start_color[1])),
-                int(start_color[2] + t * (end_color[2] - start_color[2])),
-            )
-
-            # Calculate the number of LEDs to light up based on the elapsed time
-            num_leds = int(self.np.n * t) + 1
-            for i in range(num_leds):
-                self.np[i] = current_color
-            self.np.write()
+            self.draw_sunrise_at(table, elapsed_ms, duration_ms, ms_per_step)
 
-            sleep(1)  # Update every second
+            yield frame_ms
 
     def deinit(self):
+        self.stop_animation()
         self.stop_update_analog_clock_timer()
         self.all_off()
 
@@ -214,6 +484,35 @@ class MockStateManager:
     
     def log_emit(self, message, source):
         print("[{}] {}".format(source, message))
+
+class MockNeoPixel:
+    # stands in for neopixel.NeoPixel, same buffer layout, write() only counts
+    ORDER = (1, 0, 2, 3)
+
+    def __init__(self, n=16, bpp=3):
+        self.n = n
+        self.bpp = bpp
+        self.buf = bytearray(n * bpp)
+        self.writes = 0
+
+    def __len__(self):
+        return self.n
+
+    def __setitem__(self, i, v):
+        offset = i * self.bpp
+        for j in range(self.bpp):
+            self.buf[offset + self.ORDER[j]] = v[j]
+
+    def __getitem__(self, i):
+        offset = i * self.bpp
+        return tuple(self.buf[offset + self.ORDER[j]] for j in range(self.bpp))
+
+    def fill(self, v):
+        for i in range(self.n):
+            self[i] = v
+
+    def write(self):
+        self.writes += 1
     
 ## Tests
 
@@ -248,6 +547,7 @@ def pendulum_runs_pendulum_effect():
     #[WHEN]: NeoPixelManager runs a pendulum effect
     np_mgr.pendulum([(255, 0, 0), (0, 255, 0), (0, 0, 255)])
     #[THEN]: NeoPixelManager has a pendulum effect running
+    assert np_mgr.is_animation_running(), "Expected the pendulum to run in the background"
     sleep(1)
     #[TEARDOWN]: NeoPixelManager turns off all LEDs
     np_mgr.all_off()
@@ -313,4 +613,252 @@ def sunrise_runs_sunrise_effect():
     #[THEN]: NeoPixelManager has a sunrise effect running
     sleep(1)
     #[TEARDOWN]: NeoPixelManager turns off all LEDs
-    np_mgr.all_off()
\ No newline at end of file
+    np_mgr.all_off()
+
+def frame_tables_match_per_pixel_effects():
+    #[GIVEN]: NeoPixelManager instance on a mock strip
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+    #[WHEN]: the chase is played
+    animation = np_mgr.chase_animation(colors, loops=2)
+    #[THEN]: every frame equals what per pixel assignment produces
+    reference = MockNeoPixel()
+    for i in range(2 * reference.n):
+        next(animation)
+        reference.fill((0, 0, 0))
+        for j, color in enumerate(colors):
+            reference[(i + j) % reference.n] = color
+        assert bytes(np_mgr.np.buf) == bytes(reference.buf), "Frame {} differs".format(i)
+    #[THEN]: pendulum goes forth and back, chase and turning wheel are rotated from a single frame
+    assert len(np_mgr.get_frame_table('pendulum', colors)) == 2 * np_mgr.np.n, "Expected 2n pendulum frames"
+    assert len(np_mgr.get_frame_table('chase', colors)) == 1, "Expected 1 chase frame"
+    assert len(np_mgr.get_frame_table('turning_wheel', (255, 0, 0))) == 1, "Expected 1 turning wheel frame"
+
+def benchmark_frame_tables():
+    #[GIVEN]: NeoPixelManager instance on a mock strip, so only the cpu time is measured
+    from utime import ticks_us
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (0, 255, 255)]
+    n = np_mgr.np.n
+    rounds = 20
+    #[WHEN]: frames are computed per pixel, the way the effects used to do it
+    start = ticks_us()
+    for _ in range(rounds):
+        for i in range(n):
+            for j, color in enumerate(colors):
+                np_mgr.np[(i+j)%n] = color
+            np_mgr.np.write()
+            np_mgr.np[i] = (0, 0, 0)
+    loop_us = ticks_diff(ticks_us(), start) / (rounds * n)
+    #[WHEN]: frames are played from the precomputed table
+    start = ticks_us()
+    frames = np_mgr.get_frame_table('pendulum', colors)
+    compile_us = ticks_diff(ticks_us(), start)
+    start = ticks_us()
+    for _ in range(rounds):
+        for frame in frames[:n]:
+            np_mgr.show_frame(frame)
+    table_us = ticks_diff(ticks_us(), start) / (rounds * n)
+    #[WHEN]: frames are rotated along the ring in place
+    start = ticks_us()
+    for _ in range(rounds * n):
+        np_mgr.rotate()
+        np_mgr.np.write()
+    rotate_us = ticks_diff(ticks_us(), start) / (rounds * n)
+    #[THEN]: we can compare the cost per frame
+    print("chase per frame: loops {:.1f} us, frame table {:.1f} us (compiled once in {} us), rotate {:.1f} us".format(loop_us, table_us, compile_us, rotate_us))
+
+def animation_stops_between_frames():
+    #[GIVEN]: NeoPixelManager instance on a mock strip running a chase
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    np_mgr.chase([(255, 0, 0), (0, 255, 0)], delay=0.5, loops=10)
+    #[WHEN]: a few frames are stepped, the way the timer does it
+    for _ in range(3):
+        np_mgr.step_animation()
+    writes = np_mgr.np.writes
+    assert writes == 4, "Expected one write per step, got {}".format(writes)
+    #[WHEN]: the animation is stopped
+    np_mgr.stop_animation()
+    #[THEN]: no further frame is drawn
+    np_mgr.step_animation()
+    np_mgr.process_animation()
+    assert not np_mgr.is_animation_running(), "Expected the animation to be gone"
+    assert np_mgr.np.writes == writes, "Expected no writes after stopping"
+
+def get_color_matches_float_formula():
+    #[GIVEN]: NeoPixelManager instance
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    #[WHEN]: every channel value is scaled at every brightness level
+    for brightness in np_mgr.BRIGHTNESS_LEVELS + (0.3,):
+        for v in range(256):
+            color = np_mgr.get_color(v, 255 - v, v, brightness)
+            #[THEN]: the lookup matches the float formula within rounding
+            expected = (v * brightness, (255 - v) * brightness, v * brightness)
+            for channel in range(3):
+                assert abs(color[channel] - expected[channel]) < 1, "Mismatch at {} brightness {}".format(v, brightness)
+    #[THEN]: gamma correction keeps black and white and never goes down
+    gamma = np_mgr.gamma_lut
+    assert gamma[0] == 0 and gamma[255] == 255, "Expected gamma to keep the end points"
+    assert all(gamma[v] <= gamma[v + 1] for v in range(255)), "Expected gamma to be monotonic"
+    assert np_mgr.get_color(255, 128, 0, 1.0, True) == (255, gamma[128], 0), "Expected gamma corrected channels"
+
+def benchmark_get_color():
+    #[GIVEN]: NeoPixelManager instance
+    from utime import ticks_us
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    rounds = 1000
+    brightness = 0.2
+    #[WHEN]: colors are scaled with float math, the way get_color used to do it
+    start = ticks_us()
+    for i in range(rounds):
+        v = i & 0xFF
+        color = (int(v * brightness), int(221 * brightness), int(148 * brightness))
+    float_us = ticks_diff(ticks_us(), start) / rounds
+    #[WHEN]: colors are scaled with the lookup tables
+    start = ticks_us()
+    for i in range(rounds):
+        color = np_mgr.get_color(i & 0xFF, 221, 148, brightness)
+    lut_us = ticks_diff(ticks_us(), start) / rounds
+    #[THEN]: we can compare the cost per color
+    print("color per call: float {:.2f} us, lookup table {:.2f} us".format(float_us, lut_us))
+
+def analog_clock_writes_only_when_a_hand_moves():
+    #[GIVEN]: NeoPixelManager instance on a mock strip with a fixed clock
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    now = [2024, 1, 1, 12, 0, 0, 0, 1]
+    np_mgr.get_now = lambda: now
+    #[WHEN]: the clock is drawn twice at the same time
+    np_mgr.analog_clock()
+    np_mgr.analog_clock()
+    #[THEN]: the ring is written once
+    assert np_mgr.np.writes == 1, "Expected one write, got {}".format(np_mgr.np.writes)
+    #[THEN]: all hands share one led in their mixed color
+    hour, minute, second = np_mgr.get_color(255, 0, 0, 0.05), np_mgr.get_color(0, 255, 0, 0.05), np_mgr.get_color(0, 0, 255, 0.05)
+    mixed = tuple((hour[i] + minute[i] + second[i]) // 3 for i in range(3))
+    assert np_mgr.np[8] == mixed, "Expected the mixed color, got {}".format(np_mgr.np[8])
+    #[WHEN]: the second hand moves to the next led
+    now[5] = 4
+    np_mgr.analog_clock()
+    #[THEN]: the ring is written once more and the hands are split up
+    assert np_mgr.np.writes == 2, "Expected a second write, got {}".format(np_mgr.np.writes)
+    assert np_mgr.np[9] == second, "Expected the second hand on its own led"
+    assert np_mgr.np[8] == tuple((hour[i] + minute[i]) // 2 for i in range(3)), "Expected hour and minute mixed"
+    #[WHEN]: a few seconds pass without the second hand reaching the next led
+    now[5] = 5
+    np_mgr.analog_clock()
+    #[THEN]: nothing is written
+    assert np_mgr.np.writes == 2, "Expected no write while no hand moves"
+    assert sum(1 for i in range(np_mgr.np.n) if np_mgr.np[i] != (0, 0, 0)) == 2, "Expected exactly two lit leds"
+
+def sunrise_table_goes_from_red_to_warm_white():
+    #[GIVEN]: NeoPixelManager instance
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    #[WHEN]: the sunrise is compiled
+    table = np_mgr.compile_sunrise()
+    #[THEN]: it starts as a dim but visible red and ends as warm white at the sunrise brightness
+    assert table[0] > 0 and table[1] == 0 and table[2] == 0, "Expected a dim red start, got {}".format(tuple(table[0:3]))
+    assert tuple(table[-3:]) == np_mgr.get_color(255, 221, 148, np_mgr.SUNRISE_BRIGHTNESS), "Expected warm white at the end"
+    #[THEN]: it never gets darker
+    for step in range(np_mgr.SUNRISE_STEPS):
+        assert sum(table[3 * step:3 * step + 3]) <= sum(table[3 * step + 3:3 * step + 6]), "Expected no dip at step {}".format(step)
+
+def benchmark_sunrise_frame():
+    #[GIVEN]: NeoPixelManager instance on a mock strip, so only the cpu time is measured
+    from utime import ticks_us
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    table = np_mgr.compile_sunrise()
+    frames = 500
+    last_position = (np_mgr.SUNRISE_STEPS << 8)
+    #[WHEN]: frames across the whole sunrise are drawn with every led lit
+    start = ticks_us()
+    for i in range(frames):
+        if np_mgr.draw_sunrise_frame(table, i * last_position // frames, np_mgr.np.n):
+            np_mgr.np.write()
+    frame_us = ticks_diff(ticks_us(), start) / frames
+    #[THEN]: we can compare the cost per frame with the frame budget
+    budget_us = 1000000 // np_mgr.SUNRISE_FPS
+    print("sunrise per frame: {:.1f} us of {} us at {} fps, {} of {} frames written".format(frame_us, budget_us, np_mgr.SUNRISE_FPS, np_mgr.np.writes, frames))
+
+def sunrise_frames_do_not_allocate_late_in_the_sunrise():
+    #[GIVEN]: NeoPixelManager instance on a mock strip, two minutes into a five minute sunrise
+    from gc import collect, mem_alloc
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    table = np_mgr.compile_sunrise()
+    duration_ms = 300000
+    ms_per_step = duration_ms // np_mgr.SUNRISE_STEPS
+    elapsed_ms = 120000
+    np_mgr.draw_sunrise_at(table, elapsed_ms, duration_ms, ms_per_step)
+    #[WHEN]: the rest of the sunrise is drawn at 25 fps
+    collect()
+    alloc_before = mem_alloc()
+    while elapsed_ms <= duration_ms:
+        np_mgr.draw_sunrise_at(table, elapsed_ms, duration_ms, ms_per_step)
+        elapsed_ms += 40
+    allocated = mem_alloc() - alloc_before
+    #[THEN]: nothing was allocated on the heap and the ring ends fully lit in the last color
+    print("Allocated during {} sunrise frames: {} bytes".format((duration_ms - 120000) // 40, allocated))
+    assert allocated == 0, "Expected sunrise frames not to allocate"
+    last = 3 * np_mgr.SUNRISE_STEPS
+    assert np_mgr.np[np_mgr.np.n - 1] == (table[last], table[last + 1], table[last + 2]), "Expected the last color on the whole ring"
+
+def direct_buffer_matches_pixel_assignment():
+    #[GIVEN]: NeoPixelManager instance on a mock strip and a reference strip
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    reference = MockNeoPixel()
+    #[WHEN]: part of the ring is filled
+    np_mgr.fill((10, 20, 30), 3, 5)
+    for i in range(3, 8):
+        reference[i] = (10, 20, 30)
+    #[THEN]: the buffer equals what per pixel assignment produces
+    assert bytes(np_mgr.get_buffer()) == bytes(reference.buf), "Expected fill to match"
+    #[WHEN]: the ring is rotated forth and back
+    np_mgr.rotate()
+    assert np_mgr.np[8] == (10, 20, 30) and np_mgr.np[3] == (0, 0, 0), "Expected the pixels one led further"
+    np_mgr.rotate(False)
+    #[THEN]: it is back where it started
+    assert bytes(np_mgr.get_buffer()) == bytes(reference.buf), "Expected rotate to be reversible"
+    #[WHEN]: the last led is rotated forward
+    np_mgr.fill((1, 2, 3), 15, 1)
+    np_mgr.rotate()
+    #[THEN]: it wraps around to the first
+    assert np_mgr.np[0] == (1, 2, 3), "Expected the ring to wrap around"
+
+def benchmark_direct_buffer():
+    #[GIVEN]: NeoPixelManager instance on a mock strip, so only the cpu time is measured
+    from utime import ticks_us
+    state_mgr = MockStateManager()
+    np_mgr = NeoPixelManager(state_mgr)
+    np_mgr.np = MockNeoPixel()
+    n = np_mgr.np.n
+    rounds = 100
+    color = (51, 44, 29)
+    #[WHEN]: the ring is filled pixel by pixel, the way the effects used to do it
+    start = ticks_us()
+    for _ in range(rounds):
+        for i in range(n):
+            np_mgr.np[i] = color
+    setitem_us = ticks_diff(ticks_us(), start) / rounds
+    #[WHEN]: the ring is filled through the buffer kernel
+    start = ticks_us()
+    for _ in range(rounds):
+        np_mgr.fill(color)
+    fill_us = ticks_diff(ticks_us(), start) / rounds
+    #[THEN]: we can compare the cost per frame
+    print("fill per frame: per pixel {:.1f} us, buffer kernel {:.1f} us".format(setitem_us, fill_us))
@@ -8,6 +8,7 @@ class PowerManager:
         self.conversion_factor = 3.3 / 65535
         self.vsys_voltage = 0
         self.temperature = 0
+        self.vbus = Pin("WL_GPIO2", Pin.IN) # created once, is_usb_powered is called on every compose
         
     def initialize(self):
         self.read_vsys()
@@ -29,8 +30,7 @@ class PowerManager:
             return int((self.vsys_voltage - self.lower_bound) * 100 / (self.upper_bound - self.lower_bound))
         
     def is_usb_powered(self):
-        vbus = Pin("WL_GPIO2", Pin.IN)
-        return vbus.value()
+        return self.vbus.value()
     
     def get_pad(self, gpio):
         return mem32[0x4001c000 | (4+ (4 * gpio))]
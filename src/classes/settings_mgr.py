@@ -0,0 +1,297 @@
+import micropython
+import json
+import struct
+import uos
+from binascii import crc32
+from machine import Timer
+
+class SettingsJournal:
+    # append-only key/value records: magic, key length, value length, crc32 of key and value, key, value
+    # the last good record of a key wins, a value length of 0 removes the key
+    # reading stops at the first record that is torn or fails its crc, compaction then rewrites the live records
+    MAGIC = 0xA5
+    HEADER = '<BBHI'
+    HEADER_SIZE = 8
+    COMPACT_SIZE = 4096 # bytes, the journal is compacted once it grows beyond this
+
+    def __init__(self, path):
+        self.path = path
+        self.values = {} # key -> value bytes, None for removed keys
+        self.size = 0 # bytes of good records in the file
+        self.bytes_written = 0
+        self.compactions = 0
+
+    def open(self):
+        self.values = {}
+        self.size = 0
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return
+        view = memoryview(data)
+        pos = 0
+        while pos + self.HEADER_SIZE <= len(data):
+            magic, key_length, value_length, crc = struct.unpack_from(self.HEADER, data, pos)
+            start = pos + self.HEADER_SIZE
+            end = start + key_length + value_length
+            if magic != self.MAGIC or end > len(data) or crc32(view[start:end]) != crc:
+                break
+            key = str(bytes(view[start:start + key_length]), 'utf-8')
+            self.values[key] = bytes(view[start + key_length:end]) if value_length else None
+            pos = end
+        self.size = pos
+        if pos < len(data):
+            self.compact() # drop the broken tail, so new records are not appended behind it
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def keys(self):
+        return self.values.keys()
+
+    def encode(self, key, value):
+        key = key.encode()
+        payload = key + value if value is not None else key
+        return struct.pack(self.HEADER, self.MAGIC, len(key), len(payload) - len(key), crc32(payload)) + payload
+
+    def append(self, items):
+        # items: list of (key, value bytes or None), written in one go
+        records = b''.join(self.encode(key, value) for key, value in items)
+        with open(self.path, 'ab') as file:
+            file.write(records)
+        self.size += len(records)
+        self.bytes_written += len(records)
+        for key, value in items:
+            self.values[key] = value
+        if self.size > self.COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        # the live records go to a temp file that replaces the journal in one rename
+        records = b''.join(self.encode(key, value) for key, value in self.values.items())
+        with open(self.path + '.tmp', 'wb') as file:
+            file.write(records)
+        uos.rename(self.path + '.tmp', self.path)
+        self.size = len(records)
+        self.bytes_written += len(records)
+        self.compactions += 1
+
+class SettingsManager:
+    FLUSH_DELAY = 5000 # ms, changes within this window end up in one write
+
+    def __init__(self, state_mgr, settings_dir='settings'):
+        self.state_mgr = state_mgr
+        self.settings_dir = settings_dir
+        # the json files hold the defaults and are never written, changes go to the journal as 'name/key' records
+        self.journal = SettingsJournal('{}/journal.bin'.format(settings_dir))
+        self.journal_open = False
+        self.settings = {} # name -> dict, defaults with the journal applied, kept in ram
+        self.dirty = set() # 'name/key'
+        self.flush_timer = None
+        self.flush_timer_callback_ref = self.flush_timer_callback # bound once, so re-arming does not allocate
+        self.flush_scheduled_ref = self.flush_scheduled
+        self.writes = 0
+
+    def get_path(self, name):
+        return '{}/{}.json'.format(self.settings_dir, name)
+
+    def load(self, name):
+        settings = self.settings.get(name)
+        if settings is None:
+            if not self.journal_open:
+                self.journal.open()
+                self.journal_open = True
+            path = self.get_path(name)
+            try:
+                with open(path, 'r') as file:
+                    settings = json.load(file)
+            except (OSError, ValueError):
+                settings = {}
+            prefix = name + '/'
+            for journal_key in self.journal.keys():
+                if journal_key.startswith(prefix):
+                    value = self.journal.get(journal_key)
+                    key = journal_key[len(prefix):]
+                    if value is None:
+                        settings.pop(key, None)
+                    else:
+                        settings[key] = json.loads(value)
+            self.settings[name] = settings
+        return settings
+
+    def get(self, name, key, default=None):
+        return self.load(name).get(key, default)
+
+    def set(self, name, key, value):
+        settings = self.load(name)
+        if key in settings and settings[key] == value:
+            return # unchanged, nothing to write
+        settings[key] = value
+        self.mark_dirty(name, key)
+
+    def remove(self, name, key):
+        settings = self.load(name)
+        if key in settings:
+            del settings[key]
+            self.mark_dirty(name, key)
+
+    def mark_dirty(self, name, key):
+        self.dirty.add(name + '/' + key)
+        if self.flush_timer is None:
+            self.flush_timer = Timer()
+        self.flush_timer.init(mode=Timer.ONE_SHOT, period=self.FLUSH_DELAY, callback=self.flush_timer_callback_ref)
+
+    def is_dirty(self):
+        return len(self.dirty) > 0
+
+    def flush_timer_callback(self, _):
+        try:
+            micropython.schedule(self.flush_scheduled_ref, None)
+        except RuntimeError:
+            pass # schedule queue is full, deinit or the next change flushes
+
+    def flush_scheduled(self, _):
+        self.flush()
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.deinit()
+        if not self.dirty:
+            return
+        items = []
+        for journal_key in self.dirty:
+            name, key = journal_key.split('/', 1)
+            settings = self.settings[name]
+            items.append((journal_key, json.dumps(settings[key]).encode() if key in settings else None))
+        self.dirty = set()
+        self.journal.append(items)
+        self.writes += 1
+        self.state_mgr.log_emit("Settings written: {} records".format(len(items)), self.__class__.__name__)
+
+    def get_writes(self):
+        return self.writes
+
+    def get_bytes_written(self):
+        return self.journal.bytes_written
+
+    def deinit(self):
+        self.flush()
+        if self.flush_timer is not None:
+            self.flush_timer.deinit()
+            self.flush_timer = None
+
+## Mocks for testing
+# use to test SettingsManager in isolation
+
+class MockStateManager:
+    def __init__(self):
+        pass
+
+    def log_emit(self, message, source):
+        print("[{}] {}".format(source, message))
+
+def make_test_settings_dir():
+    # an empty settings directory for the tests, so the real journal is left alone
+    remove_test_settings_dir()
+    uos.mkdir('test_settings')
+    return 'test_settings'
+
+def remove_test_settings_dir():
+    try:
+        for name in uos.listdir('test_settings'):
+            uos.remove('test_settings/' + name)
+        uos.rmdir('test_settings')
+    except OSError:
+        pass
+
+## Tests
+
+def settings_manager_coalesces_writes():
+    #[GIVEN]: SettingsManager instance on an empty settings directory
+    state_mgr = MockStateManager()
+    settings_mgr = SettingsManager(state_mgr, make_test_settings_dir())
+    #[WHEN]: several values are changed, one of them twice
+    settings_mgr.set('alarm', 'alarm_active', True)
+    settings_mgr.set('alarm', 'alarm_active', False)
+    settings_mgr.set('alarm', 'volume', 20)
+    #[THEN]: nothing is written yet
+    assert settings_mgr.get_writes() == 0, "Expected no write before flushing"
+    #[WHEN]: the settings are flushed
+    settings_mgr.flush()
+    #[THEN]: they are written once
+    assert settings_mgr.get_writes() == 1, "Expected one write, got {}".format(settings_mgr.get_writes())
+    #[WHEN]: a value is set to what it already is and flushed again
+    settings_mgr.set('alarm', 'volume', 20)
+    settings_mgr.flush()
+    #[THEN]: nothing is written
+    assert settings_mgr.get_writes() == 1, "Expected no write for an unchanged value"
+    #[THEN]: the values read back from flash
+    assert SettingsManager(state_mgr, 'test_settings').get('alarm', 'alarm_active') is False, "Expected the last value on flash"
+    #[TEARDOWN]: remove the test settings
+    settings_mgr.deinit()
+    remove_test_settings_dir()
+
+def settings_manager_applies_journal_over_defaults():
+    #[GIVEN]: SettingsManager instance with a json defaults file
+    state_mgr = MockStateManager()
+    settings_dir = make_test_settings_dir()
+    with open(settings_dir + '/alarm.json', 'w') as file:
+        json.dump({'alarm_time': '08:00', 'alarm_active': True}, file)
+    settings_mgr = SettingsManager(state_mgr, settings_dir)
+    #[WHEN]: one default is changed and one removed
+    settings_mgr.set('alarm', 'alarm_active', False)
+    settings_mgr.remove('alarm', 'alarm_time')
+    settings_mgr.flush()
+    #[THEN]: after a reboot the journal wins over the defaults, which are left untouched
+    settings = SettingsManager(state_mgr, settings_dir).load('alarm')
+    assert settings == {'alarm_active': False}, "Expected the journal applied, got {}".format(settings)
+    with open(settings_dir + '/alarm.json', 'r') as file:
+        assert json.load(file)['alarm_active'] is True, "Expected the defaults file unchanged"
+    #[TEARDOWN]: remove the test settings
+    remove_test_settings_dir()
+
+def settings_journal_recovers_from_torn_writes():
+    #[GIVEN]: a journal with a few good records
+    journal = SettingsJournal(make_test_settings_dir() + '/journal.bin')
+    journal.append([('alarm/alarm_active', b'true'), ('alarm/volume', b'20')])
+    good_size = journal.size
+    journal.append([('alarm/alarm_active', b'false')])
+    with open(journal.path, 'rb') as file:
+        data = file.read()
+    #[WHEN]: power is lost at every byte of the last record
+    for cut in range(good_size, len(data)):
+        with open(journal.path, 'wb') as file:
+            file.write(data[:cut])
+        journal.open()
+        #[THEN]: the last good value is recovered and the broken tail is gone
+        assert journal.get('alarm/alarm_active') == b'true', "Expected the last good value at cut {}".format(cut)
+        assert journal.get('alarm/volume') == b'20', "Expected older records intact at cut {}".format(cut)
+        assert uos.stat(journal.path)[6] == journal.size, "Expected the tail compacted away at cut {}".format(cut)
+    #[WHEN]: a byte in the last record is flipped
+    corrupt = bytearray(data)
+    corrupt[-1] ^= 0xFF
+    with open(journal.path, 'wb') as file:
+        file.write(corrupt)
+    journal.open()
+    #[THEN]: the crc catches it
+    assert journal.get('alarm/alarm_active') == b'true', "Expected a corrupt record to be dropped"
+    #[TEARDOWN]: remove the test settings
+    remove_test_settings_dir()
+
+def settings_journal_write_amplification():
+    #[GIVEN]: the alarm settings and a journal
+    toggles = 500
+    data = {'alarms': [{'minute': 480, 'weekdays': 127, 'enabled': True}], 'alarm_active': True}
+    journal = SettingsJournal(make_test_settings_dir() + '/journal.bin')
+    #[WHEN]: the alarm is toggled many times, each toggle flushed on its own
+    json_bytes = 0
+    for i in range(toggles):
+        data['alarm_active'] = i % 2 == 0
+        json_bytes += len(json.dumps(data)) # rewriting alarm.json in full
+        journal.append([('alarm/alarm_active', b'true' if i % 2 == 0 else b'false')])
+    #[THEN]: we can compare the bytes written, compactions included
+    print("{} toggles: json rewrite {} bytes, journal {} bytes in {} compactions, {:.1f}x less".format(
+        toggles, json_bytes, journal.bytes_written, journal.compactions, json_bytes / journal.bytes_written))
+    #[TEARDOWN]: remove the test settings
+    remove_test_settings_dir()
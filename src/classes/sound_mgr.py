@@ -1,14 +1,196 @@
+import micropython
 from drivers.dfplayer_mini import DFPlayerMini
-from utime import sleep
+from machine import Timer
+from utime import sleep, sleep_ms, ticks_ms, ticks_diff, ticks_add
 
 class SoundManager:
+    POLL_INTERVAL = 20 # ms, the uart is checked this often while the player boots or commands are pending
+    INIT_TIMEOUT = 5000 # ms, queued commands are sent anyway if the player never reports init complete
+    ACK_TIMEOUT = 300 # ms, the next command is sent anyway if one is not acknowledged
+    BUSY_RETRY_DELAY = 100 # ms, a command the player was too busy for is sent again after this
+    ESCALATION_INTERVAL = 1000 # ms, the alarm volume is updated this often at most
+    # (seconds after the alarm started, volume, track or None, eq or None), the volume is ramped linearly between points
+    # tops out at 10, the fixed alarm volume before the escalation, a 'sound' setting 'escalation' overrides it
+    ESCALATION_CURVE = ((0, 4, 1, DFPlayerMini.EQ_CLASSIC), (60, 6, None, None), (120, 8, 2, None), (180, 10, None, DFPlayerMini.EQ_ROCK), (240, 10, 3, None))
+
     def __init__(self, state_mgr):
         self.player = DFPlayerMini(uartinstance=0, tx_pin=0, rx_pin=1, power_pin=8)
         self.state_mgr = state_mgr
+        # the player is driven by feedback frames instead of fixed delays: 'off', 'booting', 'ready', 'waiting_ack'
+        # commands are queued and sent one at a time, each once the previous one is acknowledged
+        self.player_state = 'off'
+        self.player_state_ticks = ticks_ms()
+        self.command_queue = [] # (command, parameter)
+        self.pending_command = None
+        self.next_send_ticks = ticks_ms()
+        self.poll_timer = None
+        self.poll_timer_callback_ref = self.poll_timer_callback # bound once, so re-arming does not allocate
+        self.process_player_scheduled_ref = self.process_player_scheduled
+        # the alarm gets louder in timed steps, the curve is None while no escalation runs
+        self.escalation_curve = None
+        self.escalation_start = ticks_ms()
+        self.escalation_point = 0 # next point of the curve whose track and eq are not applied yet
+        self.volume = None
+        self.escalation_timer = None
+        self.escalation_timer_callback_ref = self.escalation_timer_callback
+        self.process_escalation_scheduled_ref = self.process_escalation_scheduled
+
+    def set_player_state(self, state):
+        self.player_state = state
+        self.player_state_ticks = ticks_ms()
+
+    def get_player_state(self):
+        return self.player_state
+
+    def is_player_idle(self):
+        return self.player_state == 'ready' and not self.command_queue
+
+    # region command queue
+    def queue_command(self, command, parameter=0):
+        self.command_queue.append((command, parameter))
+        self.process_player()
+
+    def process_player(self):
+        event = self.player.read_event()
+        while event != DFPlayerMini.EVENT_NONE:
+            self.handle_event(event, self.player.event_parameter)
+            event = self.player.read_event()
+
+        now = ticks_ms()
+        elapsed = ticks_diff(now, self.player_state_ticks)
+        if self.player_state == 'booting' and elapsed >= self.INIT_TIMEOUT:
+            self.state_mgr.log_emit("No init complete from player, sending commands anyway", self.__class__.__name__)
+            self.set_player_state('ready')
+        elif self.player_state == 'waiting_ack' and elapsed >= self.ACK_TIMEOUT:
+            self.state_mgr.log_emit("No acknowledgement from player, sending next command", self.__class__.__name__)
+            self.set_player_state('ready')
+
+        if self.player_state == 'ready' and self.command_queue and ticks_diff(now, self.next_send_ticks) >= 0:
+            self.send_next_command()
+
+        if self.player_state in ('booting', 'waiting_ack') or self.command_queue:
+            self.arm_poll_timer()
+
+    def send_next_command(self):
+        self.pending_command = self.command_queue.pop(0)
+        self.player.send_command(self.pending_command[0], self.pending_command[1], True)
+        self.set_player_state('waiting_ack')
+
+    def handle_event(self, event, parameter):
+        if event == DFPlayerMini.EVENT_INIT_COMPLETE:
+            if self.player_state == 'booting':
+                self.state_mgr.log_emit("Player ready after {} ms".format(ticks_diff(ticks_ms(), self.player_state_ticks)), self.__class__.__name__)
+                self.set_player_state('ready')
+        elif event == DFPlayerMini.EVENT_REPLY:
+            if self.player_state == 'waiting_ack':
+                self.pending_command = None
+                self.set_player_state('ready')
+        elif event == DFPlayerMini.EVENT_ERROR:
+            if self.player_state == 'waiting_ack':
+                if parameter == DFPlayerMini.ERROR_BUSY:
+                    self.command_queue.insert(0, self.pending_command)
+                    self.next_send_ticks = ticks_add(ticks_ms(), self.BUSY_RETRY_DELAY)
+                else:
+                    self.state_mgr.log_emit("Player error {}".format(parameter), self.__class__.__name__)
+                self.pending_command = None
+                self.set_player_state('ready')
+
+    def arm_poll_timer(self):
+        if self.poll_timer is None:
+            self.poll_timer = Timer()
+        self.poll_timer.init(mode=Timer.ONE_SHOT, period=self.POLL_INTERVAL, callback=self.poll_timer_callback_ref)
+
+    def stop_poll_timer(self):
+        if self.poll_timer is not None:
+            self.poll_timer.deinit()
+
+    def poll_timer_callback(self, _):
+        try:
+            micropython.schedule(self.process_player_scheduled_ref, None)
+        except RuntimeError:
+            self.arm_poll_timer() # schedule queue is full, try again on the next tick
+
+    def process_player_scheduled(self, _):
+        if self.player_state != 'off':
+            self.process_player()
+    # endregion
 
-    def delay(self):
-        self.state_mgr.log_emit("Delaying", self.__class__.__name__)
-        self.player.begin()
+    # region escalation
+    def start_escalation(self, curve=None):
+        if curve is None:
+            curve = self.state_mgr.settings_get('sound', 'escalation', self.ESCALATION_CURVE)
+        self.escalation_curve = curve
+        self.escalation_start = ticks_ms()
+        self.escalation_point = 0
+        self.volume = None
+        self.process_escalation()
+
+    def stop_escalation(self):
+        self.escalation_curve = None
+        if self.escalation_timer is not None:
+            self.escalation_timer.deinit()
+
+    def is_escalating(self):
+        return self.escalation_curve is not None
+
+    def get_escalation_volume(self, curve, elapsed):
+        # linear between the two points around elapsed ms, the last volume once the curve ended
+        previous = curve[0]
+        for point in curve:
+            if point[0] * 1000 > elapsed:
+                if point is previous:
+                    return point[1]
+                span = (point[0] - previous[0]) * 1000
+                return int(previous[1] + (point[1] - previous[1]) * (elapsed - previous[0] * 1000) / span)
+            previous = point
+        return previous[1]
+
+    def process_escalation(self):
+        curve = self.escalation_curve
+        if curve is None:
+            return
+        elapsed = ticks_diff(ticks_ms(), self.escalation_start)
+        volume = self.get_escalation_volume(curve, elapsed)
+        while self.escalation_point < len(curve) and curve[self.escalation_point][0] * 1000 <= elapsed:
+            _, _, track, eq = curve[self.escalation_point]
+            self.escalation_point += 1
+            if eq is not None:
+                self.set_eq(eq)
+            self.update_volume(volume)
+            if track is not None:
+                self.play(track)
+        self.update_volume(volume)
+        if self.escalation_point < len(curve):
+            self.arm_escalation_timer()
+        else:
+            self.escalation_curve = None # loudest point reached, nothing left to change
+
+    def update_volume(self, volume):
+        # one volume command per change, a change while the last one still waits in the queue replaces it
+        if volume == self.volume:
+            return
+        self.volume = volume
+        for i in range(len(self.command_queue)):
+            if self.command_queue[i][0] == DFPlayerMini.CMD_SET_VOLUME:
+                self.command_queue[i] = (DFPlayerMini.CMD_SET_VOLUME, volume)
+                return
+        self.set_volume(volume)
+
+    def arm_escalation_timer(self):
+        if self.escalation_timer is None:
+            self.escalation_timer = Timer()
+        self.escalation_timer.init(mode=Timer.ONE_SHOT, period=self.ESCALATION_INTERVAL, callback=self.escalation_timer_callback_ref)
+
+    def escalation_timer_callback(self, _):
+        try:
+            micropython.schedule(self.process_escalation_scheduled_ref, None)
+        except RuntimeError:
+            self.arm_escalation_timer() # schedule queue is full, try again on the next tick
+
+    def process_escalation_scheduled(self, _):
+        if self.player_state != 'off':
+            self.process_escalation()
+    # endregion
 
     def reset(self):
         self.state_mgr.log_emit("Resetting player", self.__class__.__name__)
@@ -16,65 +198,66 @@ class SoundManager:
 
     def set_eq(self, eq):
         self.state_mgr.log_emit("Setting equalizer to " + str(eq), self.__class__.__name__)
-        self.player.set_equalizer(eq)
+        self.queue_command(DFPlayerMini.CMD_SET_EQ, eq)
 
     def set_volume(self, volume):
         self.state_mgr.log_emit("Setting volume to " + str(volume), self.__class__.__name__)
-        self.player.set_volume(volume)
+        self.queue_command(DFPlayerMini.CMD_SET_VOLUME, volume)
 
     def play(self, track):
         self.state_mgr.log_emit("Playing track " + str(track), self.__class__.__name__)
-        self.player.play_track(track)
+        self.queue_command(DFPlayerMini.CMD_PLAY_TRACK, track)
 
     def pause(self):
         self.state_mgr.log_emit("Pausing", self.__class__.__name__)
-        self.player.pause()
+        self.queue_command(DFPlayerMini.CMD_PAUSE)
 
     def resume(self):
         self.state_mgr.log_emit("Resuming", self.__class__.__name__)
-        self.player.resume()
+        self.queue_command(DFPlayerMini.CMD_PLAY)
 
     def stop(self):
         self.state_mgr.log_emit("Stopping", self.__class__.__name__)
-        self.player.stop()
+        self.queue_command(DFPlayerMini.CMD_STOP)
 
     def standby(self):
         self.state_mgr.log_emit("Standing by", self.__class__.__name__)
-        self.player.sleep()
+        self.queue_command(DFPlayerMini.CMD_SLEEP_MODE)
 
     def wake_up(self):
         self.state_mgr.log_emit("Waking up", self.__class__.__name__)
-        self.player.wake_up()
+        self.queue_command(DFPlayerMini.CMD_WAKE_UP)
 
     def power_on(self):
         self.state_mgr.log_emit("Powering on", self.__class__.__name__)
         self.player.power_on()
+        if self.player_state == 'off':
+            self.player.clear_feedback()
+            self.set_player_state('booting')
+            self.arm_poll_timer()
 
     def power_off(self):
         self.state_mgr.log_emit("Powering off", self.__class__.__name__)
+        self.stop_poll_timer()
+        self.command_queue = []
+        self.pending_command = None
         self.player.power_off()
+        self.set_player_state('off')
 
     def alarm_sequence(self):
+        # returns right away, the commands go out as soon as the player reports it is ready
+        # and the volume is raised along the escalation curve from then on
         self.state_mgr.log_emit("Playing alarm sequence", self.__class__.__name__)
         self.power_on()
-        self.state_mgr.log_emit("Powering on", self.__class__.__name__)
-        for i in range(1, 20):
-            self.delay()
-            i += 1
-        self.state_mgr.log_emit("Should be powered on", self.__class__.__name__)
-        self.set_eq(4) # classic
-        self.delay()
-        self.set_volume(10) # medium volume
-        self.delay()
-        self.play(1)
-        self.delay()
+        self.start_escalation()
 
     def alarm_stop(self):
         self.state_mgr.log_emit("Stopping alarm sequence", self.__class__.__name__)
+        self.stop_escalation()
         self.power_off()
 
     def deinit(self):
-        self.delay()
+        self.stop_escalation()
         self.power_off()
 
 ## Mocks for testing
@@ -88,6 +271,122 @@ class MockStateManager:
 
     def log_emit(self, msg, source):
         print(f"{source}: {msg}")
+
+    def settings_get(self, name, key, default=None):
+        return default
+
+class MockDFPlayerUART:
+    # simulates the module behind the player's uart, speaking the real frame protocol
+    # boot_ms: init complete is reported this long after power on, None never reports it
+    # busy_ms: a command arriving this soon after the previous accepted one is answered with a busy error
+    # track_ms: a playing track finishes after this long
+    # latency_ms: frames take this long to come back, 10 bytes at 9600 baud
+    # commands sent before the module booted are lost like on the real module
+    def __init__(self, boot_ms=1500, busy_ms=0, track_ms=60000, latency_ms=11):
+        self.boot_ms = boot_ms
+        self.busy_ms = busy_ms
+        self.track_ms = track_ms
+        self.latency_ms = latency_ms
+        self.start = ticks_ms()
+        self.booted = False
+        self.rx = bytearray()
+        self.outgoing = [] # (due ticks, frame)
+        self.commands = [] # accepted (command, parameter, ms since power on)
+        self.busy_errors = 0
+        self.last_command_ticks = None
+        self.volume = 30
+        self.eq = 0
+        self.track = 0
+        self.playing = False
+        self.paused = False
+        self.sleeping = False
+        self.track_start = 0
+        self.audible_ms = None # ms since power on when a track first played at a volume above 0
+
+    def frame(self, command, parameter=0):
+        checksum = -(0xFF + 0x06 + command + (parameter >> 8) + (parameter & 0xFF)) & 0xFFFF
+        return bytes((0x7E, 0xFF, 0x06, command, 0x00, parameter >> 8, parameter & 0xFF, checksum >> 8, checksum & 0xFF, 0xEF))
+
+    def reply(self, command, parameter=0):
+        self.outgoing.append((ticks_add(ticks_ms(), self.latency_ms), self.frame(command, parameter)))
+
+    def update(self):
+        now = ticks_ms()
+        if not self.booted and self.boot_ms is not None and ticks_diff(now, self.start) >= self.boot_ms:
+            self.booted = True
+            self.reply(DFPlayerMini.FEEDBACK_INIT_COMPLETE, DFPlayerMini.DEVICE_TF_INSERTED)
+        if self.playing and ticks_diff(now, self.track_start) >= self.track_ms:
+            self.playing = False
+            self.reply(DFPlayerMini.TRACK_FINISHED_TF, self.track)
+        while self.outgoing and ticks_diff(now, self.outgoing[0][0]) >= 0:
+            self.rx += self.outgoing.pop(0)[1]
+
+    def any(self):
+        self.update()
+        return len(self.rx)
+
+    def readinto(self, buf):
+        self.update()
+        n = min(len(buf), len(self.rx))
+        if n == 0:
+            return None
+        buf[:n] = self.rx[:n]
+        self.rx = self.rx[n:]
+        return n
+
+    def write(self, packet):
+        self.update()
+        if not self.booted:
+            return len(packet)
+        now = ticks_ms()
+        if len(packet) != 10 or -sum(packet[1:7]) & 0xFFFF != (packet[7] << 8 | packet[8]):
+            self.reply(DFPlayerMini.FEEDBACK_ERROR, DFPlayerMini.ERROR_CHECKSUM_NOT_MATCH)
+            return len(packet)
+        command, parameter = packet[3], (packet[5] << 8) | packet[6]
+        if self.last_command_ticks is not None and ticks_diff(now, self.last_command_ticks) < self.busy_ms:
+            self.busy_errors += 1
+            self.reply(DFPlayerMini.FEEDBACK_ERROR, DFPlayerMini.ERROR_BUSY)
+            return len(packet)
+        if self.sleeping and command != DFPlayerMini.CMD_WAKE_UP:
+            self.reply(DFPlayerMini.FEEDBACK_ERROR, DFPlayerMini.ERROR_SLEEPING)
+            return len(packet)
+        self.last_command_ticks = now
+        self.commands.append((command, parameter, ticks_diff(now, self.start)))
+        self.execute(command, parameter)
+        if packet[4]:
+            self.reply(DFPlayerMini.FEEDBACK_REPLY)
+        return len(packet)
+
+    def execute(self, command, parameter):
+        if command == DFPlayerMini.CMD_SET_VOLUME:
+            self.volume = min(parameter, 30)
+        elif command == DFPlayerMini.CMD_INC_VOLUME:
+            self.volume = min(self.volume + 1, 30)
+        elif command == DFPlayerMini.CMD_DEC_VOLUME:
+            self.volume = max(self.volume - 1, 0)
+        elif command == DFPlayerMini.CMD_SET_EQ:
+            self.eq = parameter
+        elif command == DFPlayerMini.CMD_PLAY_TRACK:
+            self.track = parameter
+            self.playing, self.paused = True, False
+            self.track_start = ticks_ms()
+        elif command == DFPlayerMini.CMD_PAUSE:
+            self.paused = self.playing
+            self.playing = False
+        elif command == DFPlayerMini.CMD_PLAY:
+            self.playing, self.paused = self.paused or self.playing, False
+        elif command == DFPlayerMini.CMD_STOP:
+            self.playing, self.paused = False, False
+        elif command == DFPlayerMini.CMD_SLEEP_MODE:
+            self.sleeping = True
+        elif command == DFPlayerMini.CMD_WAKE_UP:
+            self.sleeping = False
+        elif command == DFPlayerMini.CMD_QUERY_STATUS:
+            self.reply(DFPlayerMini.FEEDBACK_STATUS, 0x0200 | (1 if self.playing else 2 if self.paused else 0))
+        elif command == DFPlayerMini.FEEDBACK_VOLUME:
+            self.reply(DFPlayerMini.FEEDBACK_VOLUME, self.volume)
+        if self.playing and self.volume > 0 and self.audible_ms is None:
+            self.audible_ms = ticks_diff(ticks_ms(), self.start)
     
 ## Tests
 def sound_manager_alarm_sequence_can_start_and_stop():
@@ -101,4 +400,137 @@ def sound_manager_alarm_sequence_can_start_and_stop():
     sleep(10)
     #[WHEN]: SoundManager stops the alarm sequence
     sound_mgr.alarm_stop()
-    #[THEN]: SoundManager is stopped
\ No newline at end of file
+    #[THEN]: SoundManager is stopped
+
+def run_until_idle(sound_mgr, timeout_ms):
+    # drives the player the way the poll timer does
+    start = ticks_ms()
+    while not sound_mgr.is_player_idle() and ticks_diff(ticks_ms(), start) < timeout_ms:
+        sound_mgr.process_player()
+        sleep_ms(5)
+
+def sound_manager_sends_commands_once_player_is_ready():
+    #[GIVEN]: SoundManager instance on a uart that boots in 1.5 s
+    print("Test SoundManager waits for init complete")
+    state_mgr = MockStateManager()
+    sound_mgr = SoundManager(state_mgr)
+    uart = MockDFPlayerUART(boot_ms=1500)
+    sound_mgr.player.uart = uart
+    #[WHEN]: SoundManager starts the alarm sequence
+    start = ticks_ms()
+    sound_mgr.alarm_sequence()
+    #[THEN]: it returns right away
+    assert ticks_diff(ticks_ms(), start) < 100, "Expected alarm_sequence not to block"
+    #[WHEN]: the player is driven until the queue is empty
+    run_until_idle(sound_mgr, 3000)
+    #[THEN]: all commands arrived in order, the first one right after the player booted
+    sent = [command for command, _, _ in uart.commands]
+    assert sent == [DFPlayerMini.CMD_SET_EQ, DFPlayerMini.CMD_SET_VOLUME, DFPlayerMini.CMD_PLAY_TRACK], "Expected eq, volume, play, got {}".format(sent)
+    play_ms = uart.commands[-1][2]
+    assert play_ms < 1500 + 200, "Expected play shortly after boot, got {} ms".format(play_ms)
+    print("play sent {} ms after power on".format(play_ms))
+    #[TEARDOWN]: SoundManager stops the alarm sequence
+    sound_mgr.alarm_stop()
+
+def sound_manager_falls_back_when_player_stays_silent():
+    #[GIVEN]: SoundManager instance on a uart that boots but never reports it
+    print("Test SoundManager init timeout")
+    state_mgr = MockStateManager()
+    sound_mgr = SoundManager(state_mgr)
+    sound_mgr.INIT_TIMEOUT = 300
+    uart = MockDFPlayerUART(boot_ms=None)
+    uart.booted = True
+    sound_mgr.player.uart = uart
+    #[WHEN]: SoundManager starts the alarm sequence and the player is driven
+    sound_mgr.alarm_sequence()
+    run_until_idle(sound_mgr, 2000)
+    #[THEN]: the commands are sent after the timeout
+    assert len(uart.commands) == 3, "Expected all commands sent after the timeout"
+    assert uart.commands[0][2] >= 300, "Expected nothing sent before the timeout"
+    #[TEARDOWN]: SoundManager stops the alarm sequence
+    sound_mgr.alarm_stop()
+
+def sound_manager_retries_when_player_is_busy():
+    #[GIVEN]: SoundManager instance on a player that needs 150 ms between commands
+    print("Test SoundManager busy retry")
+    state_mgr = MockStateManager()
+    sound_mgr = SoundManager(state_mgr)
+    uart = MockDFPlayerUART(boot_ms=200, busy_ms=150)
+    sound_mgr.player.uart = uart
+    #[WHEN]: SoundManager starts the alarm sequence and the player is driven
+    sound_mgr.alarm_sequence()
+    run_until_idle(sound_mgr, 3000)
+    #[THEN]: the busy commands were sent again and the player ends up in the alarm state
+    assert uart.busy_errors > 0, "Expected the player to be busy at least once"
+    assert [command for command, _, _ in uart.commands] == [DFPlayerMini.CMD_SET_EQ, DFPlayerMini.CMD_SET_VOLUME, DFPlayerMini.CMD_PLAY_TRACK], "Expected every command accepted once"
+    assert uart.eq == 4 and uart.volume == 4 and uart.playing and uart.track == 1, "Expected the alarm track playing"
+    #[TEARDOWN]: SoundManager stops the alarm sequence
+    sound_mgr.alarm_stop()
+
+def benchmark_alarm_start_latency():
+    #[GIVEN]: simulated players with different boot and busy times
+    print("Benchmark SoundManager alarm start latency")
+    for boot_ms, busy_ms in ((500, 0), (1500, 0), (1500, 50), (3000, 150)):
+        state_mgr = MockStateManager()
+        sound_mgr = SoundManager(state_mgr)
+        uart = MockDFPlayerUART(boot_ms=boot_ms, busy_ms=busy_ms)
+        sound_mgr.player.uart = uart
+        #[WHEN]: the alarm sequence starts and the player is driven until the track plays
+        start = ticks_ms()
+        uart.start = start
+        sound_mgr.alarm_sequence()
+        while uart.audible_ms is None and ticks_diff(ticks_ms(), start) < boot_ms + 3000:
+            sound_mgr.process_player()
+            sleep_ms(5)
+        #[THEN]: the track is audible shortly after the player booted
+        assert uart.audible_ms is not None, "Expected the track to play"
+        latency = uart.audible_ms - boot_ms
+        print("boot {} ms, busy {} ms: audible after {} ms, {} ms after boot, {} busy errors".format(boot_ms, busy_ms, uart.audible_ms, latency, uart.busy_errors))
+        budget = 200 + uart.busy_errors * (SoundManager.BUSY_RETRY_DELAY + SoundManager.POLL_INTERVAL)
+        assert latency < budget, "Alarm start latency regressed: {} ms after boot".format(latency)
+        #[TEARDOWN]: SoundManager stops the alarm sequence
+        sound_mgr.alarm_stop()
+
+def sound_manager_escalates_along_the_curve():
+    #[GIVEN]: SoundManager instance on a simulated player and a short escalation curve
+    print("Test SoundManager escalation")
+    state_mgr = MockStateManager()
+    sound_mgr = SoundManager(state_mgr)
+    sound_mgr.ESCALATION_INTERVAL = 50
+    uart = MockDFPlayerUART(boot_ms=100)
+    sound_mgr.player.uart = uart
+    curve = ((0, 5, 1, DFPlayerMini.EQ_CLASSIC), (0.5, 15, 2, None), (1, 20, None, DFPlayerMini.EQ_ROCK))
+    #[WHEN]: the escalation runs, driven the way its timer and the poll timer do
+    sound_mgr.power_on()
+    sound_mgr.start_escalation(curve)
+    start = ticks_ms()
+    while (sound_mgr.is_escalating() or not sound_mgr.is_player_idle()) and ticks_diff(ticks_ms(), start) < 3000:
+        sound_mgr.process_escalation()
+        sound_mgr.process_player()
+        sleep_ms(10)
+    #[THEN]: the player ends at the last point of the curve
+    assert not sound_mgr.is_escalating(), "Expected the escalation to finish"
+    assert uart.volume == 20 and uart.track == 2 and uart.eq == DFPlayerMini.EQ_ROCK, "Expected the end of the curve, got volume {} track {} eq {}".format(uart.volume, uart.track, uart.eq)
+    #[THEN]: the volume only went up, at most one command per volume step, changes made while booting were merged
+    volumes = [parameter for command, parameter, _ in uart.commands if command == DFPlayerMini.CMD_SET_VOLUME]
+    assert volumes == sorted(set(volumes)), "Expected rising volumes without repeats, got {}".format(volumes)
+    assert len(volumes) <= 20 - 5 + 1, "Expected the rate limited ramp, got {}".format(volumes)
+
+def sound_manager_escalation_stops_on_quit():
+    #[GIVEN]: SoundManager instance with a running escalation
+    print("Test SoundManager escalation quit")
+    state_mgr = MockStateManager()
+    sound_mgr = SoundManager(state_mgr)
+    uart = MockDFPlayerUART(boot_ms=100)
+    sound_mgr.player.uart = uart
+    sound_mgr.alarm_sequence()
+    run_until_idle(sound_mgr, 2000)
+    sent = len(uart.commands)
+    #[WHEN]: the alarm is stopped
+    sound_mgr.alarm_stop()
+    sound_mgr.escalation_start = ticks_add(ticks_ms(), -600000) # a late timer callback long after the start
+    sound_mgr.process_escalation_scheduled(None)
+    sound_mgr.process_escalation()
+    #[THEN]: nothing else is sent and the player is off
+    assert not sound_mgr.is_escalating(), "Expected the escalation to stop"
+    assert len(uart.commands) == sent and sound_mgr.get_player_state() == 'off', "Expected no commands after quit"
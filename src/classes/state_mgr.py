@@ -2,6 +2,7 @@ import _thread
 from utime import sleep
 from machine import freq
 from classes.log_mgr import LogManager
+from classes.settings_mgr import SettingsManager
 from classes.wifi_mgr import WifiManager
 from classes.neopixel_mgr import NeoPixelManager
 from classes.display_mgr import DisplayManager
@@ -16,6 +17,7 @@ from classes.lowpower_mgr import LowPowerManager
 class StateManager:
     def __init__(self):
         self.log_manager = LogManager(self)
+        self.settings_manager = SettingsManager(self)
         self.power_manager = PowerManager(self)
         self.wifi_manager = WifiManager(self)
         self.time_manager = TimeManager(self)
@@ -145,7 +147,8 @@ class StateManager:
         return self.menu_manager.get_system_state()
     
     def menu_is_menu_active(self):
-        return self.menu_manager.get_state() in ['system','menu']
+        state = self.menu_manager.get_state()
+        return state == 'system' or state == 'menu' # no list literal, this runs on every compose
     # endregion
 
     # region DisplayManager methods
@@ -190,6 +193,12 @@ class StateManager:
 
     def display_initialize_normal_operation(self):
         self.display_manager.initialize_normal_operation()
+
+    def display_process_render_requests(self):
+        self.display_manager.process_render_requests()
+
+    def display_resync_clock(self):
+        self.display_manager.resync_clock()
     # endregion
 
     # region NeoPixelManager methods
@@ -202,17 +211,29 @@ class StateManager:
     def neopixel_get_color(self, red, green, blue):
         return self.neopixel_manager.get_color(red, green, blue)
     
-    def neopixel_pendulum(self, colors, delay, loops):
-        self.neopixel_manager.pendulum(colors, delay, loops)
+    def neopixel_start_animation(self, animation):
+        self.neopixel_manager.start_animation(animation)
+
+    def neopixel_stop_animation(self):
+        self.neopixel_manager.stop_animation()
+
+    def neopixel_process_animation(self):
+        self.neopixel_manager.process_animation()
 
-    def neopixel_chase(self, colors, delay, loops):
-        self.neopixel_manager.chase(colors, delay, loops)
+    def neopixel_off_animation(self):
+        return self.neopixel_manager.off_animation()
 
-    def neopixel_turning_wheel(self, colors, delay, loops):
-        self.neopixel_manager.turning_wheel(colors, delay, loops)
+    def neopixel_pendulum_animation(self, colors, delay, loops):
+        return self.neopixel_manager.pendulum_animation(colors, delay, loops)
 
-    def neopixel_sunrise(self, duration):
-        self.neopixel_manager.sunrise(duration)
+    def neopixel_chase_animation(self, colors, delay, loops):
+        return self.neopixel_manager.chase_animation(colors, delay, loops)
+
+    def neopixel_turning_wheel_animation(self, color, delay, loops):
+        return self.neopixel_manager.turning_wheel_animation(color, delay, loops)
+
+    def neopixel_sunrise_animation(self, duration):
+        return self.neopixel_manager.sunrise_animation(duration)
 
     def neopixel_start_update_analog_clock_timer(self):
         self.neopixel_manager.start_update_analog_clock_timer()
@@ -265,8 +286,25 @@ class StateManager:
     def alarm_clear_last_alarm_stopped_time(self):
         self.alarm_manager.clear_last_alarm_stopped_time()
  
-    def alarm_start_alarm_sequence_thread(self):
-        self.alarm_manager.start_alarm_sequence_thread()
+    def alarm_start_alarm_sequence(self):
+        self.alarm_manager.start_alarm_sequence()
+
+    def alarm_reschedule(self):
+        self.alarm_manager.reschedule()
+    # endregion
+
+    # region SettingsManager methods
+    def settings_get(self, name, key, default=None):
+        return self.settings_manager.get(name, key, default)
+
+    def settings_set(self, name, key, value):
+        self.settings_manager.set(name, key, value)
+
+    def settings_remove(self, name, key):
+        self.settings_manager.remove(name, key)
+
+    def settings_flush(self):
+        self.settings_manager.flush()
     # endregion
 
     # region SoundManager methods
@@ -292,6 +330,9 @@ class StateManager:
     def log_emit(self, message, source_class):
         self.log_manager.emit(message, source_class)
 
+    def log_read_log(self):
+        return self.log_manager.read_log()
+
     def log_set_verbose(self, value):
         self.log_manager.set_verbose(value)
 
@@ -366,6 +407,10 @@ class StateManager:
             self.sound_manager.deinit()
         except:
             pass
+        try:
+            self.settings_manager.deinit()
+        except:
+            pass
         try:
             self.log_manager.deinit()
         except:
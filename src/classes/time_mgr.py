@@ -79,6 +79,8 @@ class TimeManager:
             data = self.get_data()
             rtc = RTC()
             rtc.datetime(self.compose_data(data))
+            self.state_mgr.display_resync_clock()
+            self.state_mgr.alarm_reschedule()
             self.state_mgr.log_emit("RTC updated", self.__class__.__name__)
         except Exception as e:
             self.state_mgr.log_emit("Error updating RTC: {}".format(e), self.__class__.__name__)
@@ -5,8 +5,12 @@
 # fixed missing method validate_checksum
 # fixed missing constants
 # added option to control power to the module
+# added optional feedback (ACK) request to send_command
+# replaced the fixed 10 byte reads with a resynchronizing frame parser on a ring buffer
+# send_command patches one preallocated packet in place, constant commands are precomputed, added send_many
 
 import machine
+import micropython
 import utime
 
 class DFPlayerMini:
@@ -99,12 +103,47 @@ class DFPlayerMini:
     MODE_SINGLE_REPEAT = 2
     MODE_RANDOM = 3
 
+    # Events reported by read_event
+    EVENT_NONE = 0
+    EVENT_INIT_COMPLETE = 1
+    EVENT_REPLY = 2
+    EVENT_ERROR = 3
+    EVENT_TRACK_FINISHED = 4
+    EVENT_STATUS = 5
+    EVENT_OTHER = 6
+
+    FRAME_SIZE = 10
+    RX_BUFFER_SIZE = 64 # power of two
+    RX_CHUNK_SIZE = 16
+
+    # Commands without a parameter whose packets are built once
+    CONSTANT_COMMANDS = (CMD_PLAY, CMD_PAUSE, CMD_STOP, CMD_NEXT, CMD_PREV, CMD_SLEEP_MODE, CMD_WAKE_UP, CMD_QUERY_STATUS)
+    FEEDBACK_KEY = 0x100 # added to the command to look up the packet asking for feedback
+
+    # Gap the module needs between two commands
+    COMMAND_SPACING_MS = 50
+
     # Initialization: Setting up serial communication.
 
     def __init__(self, tx_pin, rx_pin, uartinstance=1, power_pin=None):
         self.uart = machine.UART(uartinstance, baudrate=9600, tx=tx_pin, rx=rx_pin)
         if power_pin is not None:
             self.power_pin = machine.Pin(power_pin, machine.Pin.OUT)
+        # received bytes wait in a ring buffer until they form a complete frame
+        self.rx_ring = bytearray(self.RX_BUFFER_SIZE)
+        self.rx_start = 0
+        self.rx_count = 0
+        self.rx_chunk = bytearray(self.RX_CHUNK_SIZE)
+        self.rx_dropped = 0
+        self.event_command = 0
+        self.event_parameter = 0
+        # one packet is patched in place for every command with a parameter
+        self.tx_packet = self.build_packet(0)
+        self.constant_packets = {}
+        for command in self.CONSTANT_COMMANDS:
+            self.constant_packets[command] = self.build_packet(command)
+            self.constant_packets[command + self.FEEDBACK_KEY] = self.build_packet(command, feedback=True)
+        self.last_send_ticks = utime.ticks_ms()
             
     def power_on(self):
         """
@@ -136,31 +175,78 @@ class DFPlayerMini:
 
     # Sending Commands: General method to construct and send command packets.
 
-    def send_command(self, command, parameter=0):
+    def build_packet(self, command, parameter=0, feedback=False):
         """
-        Sends a command to the DFPlayer Mini.
+        Builds a new command packet.
 
         :param command: The command byte.
         :param parameter: The parameter for the command, default to 0.
+        :param feedback: Ask the module to acknowledge the command.
+        :return: The 10 byte packet.
+        """
+        packet = bytearray(self.FRAME_SIZE)
+        packet[0] = self.START_BYTE
+        packet[1] = self.VERSION_BYTE
+        packet[2] = 0x06
+        packet[9] = self.END_BYTE
+        self.patch_packet(packet, command, parameter, 0x01 if feedback else 0x00)
+        return packet
+
+    @micropython.native
+    def patch_packet(self, packet, command:int, parameter:int, feedback_byte:int):
+        """
+        Writes command, parameter and checksum into an existing packet.
+        """
+        packet[3] = command
+        packet[4] = feedback_byte
+        packet[5] = (parameter >> 8) & 0xFF
+        packet[6] = parameter & 0xFF
+        checksum = -(self.VERSION_BYTE + 0x06 + command + feedback_byte + packet[5] + packet[6]) & 0xFFFF
+        packet[7] = checksum >> 8
+        packet[8] = checksum & 0xFF
+
+    def send_command(self, command, parameter=0, feedback=False):
+        """
+        Sends a command to the DFPlayer Mini, without allocating.
+
+        :param command: The command byte.
+        :param parameter: The parameter for the command, default to 0.
+        :param feedback: Ask the module to acknowledge the command with a FEEDBACK_REPLY frame.
+        """
+        packet = None
+        if parameter == 0:
+            packet = self.constant_packets.get(command + self.FEEDBACK_KEY if feedback else command)
+        if packet is None:
+            packet = self.tx_packet
+            self.patch_packet(packet, command, parameter, 0x01 if feedback else 0x00)
+        self.uart.write(packet)
+        self.last_send_ticks = utime.ticks_ms()
+
+    def send_many(self, commands, feedback=False):
         """
-        param_high = parameter >> 8
-        param_low = parameter & 0xFF
-        checksum = self.calculate_checksum(command, param_high, param_low)
-        checksum_high = checksum >> 8
-        checksum_low = checksum & 0xFF
-        command_packet = bytearray([self.START_BYTE, self.VERSION_BYTE, 0x06, command, 0x00, param_high, param_low, checksum_high, checksum_low, self.END_BYTE])
-        self.uart.write(command_packet)
+        Sends several commands, keeping COMMAND_SPACING_MS between two commands.
+        Blocks for the spacing, so use it outside of time critical code.
 
-    def calculate_checksum(self, command, param_high, param_low):
+        :param commands: Iterable of (command, parameter) pairs.
+        :param feedback: Ask the module to acknowledge each command.
+        """
+        for command, parameter in commands:
+            wait = self.COMMAND_SPACING_MS - utime.ticks_diff(utime.ticks_ms(), self.last_send_ticks)
+            if wait > 0:
+                utime.sleep_ms(wait)
+            self.send_command(command, parameter, feedback)
+
+    def calculate_checksum(self, command, param_high, param_low, feedback_byte=0x00):
         """
         Calculates the checksum for a given command and parameter.
 
         :param command: The command byte.
         :param param_high: High byte of the parameter.
         :param param_low: Low byte of the parameter.
+        :param feedback_byte: 0x01 if an acknowledgement is requested, default to 0x00.
         :return: The calculated checksum.
         """
-        checksum = -(self.VERSION_BYTE + 0x06 + command + 0x00 + param_high + param_low)
+        checksum = -(self.VERSION_BYTE + 0x06 + command + feedback_byte + param_high + param_low)
         return checksum & 0xFFFF
 
     def validate_checksum(self, response):
@@ -244,41 +330,115 @@ class DFPlayerMini:
 
     # Querying Status: Get the current status of the player.
 
-    def get_status(self):
+    def get_status(self, timeout_ms=100):
         """
         Get the current status of the player.
+
+        :param timeout_ms: How long to wait for the status frame at most.
+        :return: The status byte, or None if the module did not answer in time.
         """
         self.send_command(self.CMD_QUERY_STATUS)
-        utime.sleep_ms(100)  # Wait for the module to respond
-
-        if self.uart.any():
-            response = self.uart.read(10)
-            if len(response) == 10 and response[0] == self.START_BYTE and response[9] == self.END_BYTE:
-                if self.validate_checksum(response):
-                    return response[6]  # The status byte
-                else:
-                    return "Checksum Error"
-            else:
-                return "Invalid Response"
-        else:
-            return None
+        start = utime.ticks_ms()
+        while utime.ticks_diff(utime.ticks_ms(), start) < timeout_ms:
+            event = self.read_event()
+            if event == self.EVENT_STATUS:
+                return self.event_parameter & 0xFF  # The status byte
+            if event == self.EVENT_NONE:
+                utime.sleep_ms(5)
+        return None
 
     # Feedback Handling: Process feedback from the device, like track finished, error messages.
 
+    @micropython.native
+    def feed(self):
+        """
+        Moves the bytes waiting in the uart into the ring buffer, without allocating.
+        When the ring buffer is full the oldest bytes are dropped.
+
+        :return: The number of bytes read.
+        """
+        if not self.uart.any():
+            return 0
+        n = self.uart.readinto(self.rx_chunk)
+        if not n:
+            return 0
+        ring = self.rx_ring
+        chunk = self.rx_chunk
+        mask = self.RX_BUFFER_SIZE - 1
+        for i in range(n):
+            if self.rx_count == self.RX_BUFFER_SIZE:
+                self.rx_start = (self.rx_start + 1) & mask
+                self.rx_count -= 1
+                self.rx_dropped += 1
+            ring[(self.rx_start + self.rx_count) & mask] = chunk[i]
+            self.rx_count += 1
+        return n
+
+    @micropython.native
+    def read_event(self):
+        """
+        Parses the next complete frame from the received bytes.
+        Bytes that do not start a valid frame (start byte, version, length, end byte and checksum) are skipped
+        one at a time, so a dropped or extra byte only costs the frame it hit.
+
+        :return: One of the EVENT_ constants, EVENT_NONE if no complete frame is waiting.
+            The frame's command and parameter are left in event_command and event_parameter.
+        """
+        self.feed()
+        ring = self.rx_ring
+        mask = self.RX_BUFFER_SIZE - 1
+        while self.rx_count >= self.FRAME_SIZE:
+            s = self.rx_start
+            if (ring[s] != self.START_BYTE or ring[(s + 1) & mask] != self.VERSION_BYTE
+                    or ring[(s + 2) & mask] != 0x06 or ring[(s + 9) & mask] != self.END_BYTE):
+                self.rx_start = (s + 1) & mask
+                self.rx_count -= 1
+                self.rx_dropped += 1
+                continue
+            total = 0
+            for i in range(1, 7):
+                total += ring[(s + i) & mask]
+            if (ring[(s + 7) & mask] << 8 | ring[(s + 8) & mask]) != (-total & 0xFFFF):
+                self.rx_start = (s + 1) & mask
+                self.rx_count -= 1
+                self.rx_dropped += 1
+                continue
+            command = ring[(s + 3) & mask]
+            self.event_command = command
+            self.event_parameter = ring[(s + 5) & mask] << 8 | ring[(s + 6) & mask]
+            self.rx_start = (s + self.FRAME_SIZE) & mask
+            self.rx_count -= self.FRAME_SIZE
+            if command == self.FEEDBACK_INIT_COMPLETE:
+                return self.EVENT_INIT_COMPLETE
+            if command == self.FEEDBACK_REPLY:
+                return self.EVENT_REPLY
+            if command == self.FEEDBACK_ERROR:
+                return self.EVENT_ERROR
+            if command == self.TRACK_FINISHED_TF or command == self.TRACK_FINISHED_UDISK:
+                return self.EVENT_TRACK_FINISHED
+            if command == self.FEEDBACK_STATUS:
+                return self.EVENT_STATUS
+            return self.EVENT_OTHER
+        return self.EVENT_NONE
+
+    def clear_feedback(self):
+        """
+        Drops all received bytes, e.g. after the module was powered off.
+        """
+        while self.feed():
+            pass
+        self.rx_start = 0
+        self.rx_count = 0
+
     def poll_feedback(self):
         """
         Polls the device for feedback, processing any available data.
+
+        :return: (command, parameter) of the next complete frame, None if there is none.
         """
-        if self.uart.any():
-            response = self.uart.read(10)
-            if len(response) == 10 and response[0] == self.START_BYTE and response[9] == self.END_BYTE:
-                if self.validate_checksum(response):
-                    return response[3], response[6]
-                else:
-                    return "Checksum Error"
-            else:
-                return "Invalid Response"
-        return None
+        if self.read_event() == self.EVENT_NONE:
+            return None
+        return self.event_command, self.event_parameter
 
     # Advanced Playback Options: Repeat, shuffle, play from a specific folder.
 
@@ -359,3 +519,160 @@ class DFPlayerMini:
         :param enable: Enable or disable repeat.
         """
         self.send_command(self.CMD_REPEAT_PLAY, 0x01 if enable else 0x00)
+
+## Mocks for testing
+# use to test the frame parser without the module
+
+class MockUART:
+    def __init__(self, record=True):
+        self.rx = bytearray()
+        self.packets = [] if record else None # copies of the written packets, None to keep writes allocation free
+        self.writes = 0
+
+    def push(self, data):
+        self.rx += data
+
+    def any(self):
+        return len(self.rx)
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self.rx))
+        if n == 0:
+            return None
+        buf[:n] = self.rx[:n]
+        self.rx = self.rx[n:]
+        return n
+
+    def write(self, packet):
+        self.writes += 1
+        if self.packets is not None:
+            self.packets.append((utime.ticks_ms(), bytes(packet)))
+        return len(packet)
+
+def make_frame(command, parameter=0):
+    checksum = -(0xFF + 0x06 + command + (parameter >> 8) + (parameter & 0xFF)) & 0xFFFF
+    return bytes((0x7E, 0xFF, 0x06, command, 0x00, parameter >> 8, parameter & 0xFF, checksum >> 8, checksum & 0xFF, 0xEF))
+
+def make_player(record=True):
+    player = DFPlayerMini(tx_pin=0, rx_pin=1, uartinstance=0)
+    player.uart = MockUART(record)
+    return player
+
+def read_events(player):
+    events = []
+    event = player.read_event()
+    while event != DFPlayerMini.EVENT_NONE:
+        events.append((event, player.event_command, player.event_parameter))
+        event = player.read_event()
+    return events
+
+## Tests
+
+def dfplayer_parses_concatenated_frames():
+    #[GIVEN]: a player and three frames arriving in one read
+    player = make_player()
+    player.uart.push(make_frame(DFPlayerMini.FEEDBACK_INIT_COMPLETE, 2) + make_frame(DFPlayerMini.FEEDBACK_REPLY) + make_frame(DFPlayerMini.TRACK_FINISHED_TF, 1))
+    #[WHEN]: the events are read
+    events = read_events(player)
+    #[THEN]: each frame is one typed event
+    assert [e[0] for e in events] == [DFPlayerMini.EVENT_INIT_COMPLETE, DFPlayerMini.EVENT_REPLY, DFPlayerMini.EVENT_TRACK_FINISHED], "Got {}".format(events)
+    assert events[2][2] == 1, "Expected the finished track number"
+
+def dfplayer_parses_split_frames():
+    #[GIVEN]: a player and a frame arriving one byte at a time
+    player = make_player()
+    frame = make_frame(DFPlayerMini.FEEDBACK_ERROR, DFPlayerMini.ERROR_BUSY)
+    #[WHEN]: all but the last byte have arrived
+    events = []
+    for byte in frame[:-1]:
+        player.uart.push(bytes((byte,)))
+        events += read_events(player)
+    #[THEN]: there is no event yet
+    assert events == [], "Expected no event from a partial frame"
+    #[WHEN]: the last byte arrives
+    player.uart.push(frame[-1:])
+    #[THEN]: the error event is reported
+    assert read_events(player) == [(DFPlayerMini.EVENT_ERROR, DFPlayerMini.FEEDBACK_ERROR, DFPlayerMini.ERROR_BUSY)], "Expected the busy error"
+
+def dfplayer_resynchronizes_on_noise():
+    #[GIVEN]: a player and frames mixed with noise, false start bytes, a truncated and a corrupt frame
+    player = make_player()
+    corrupt = bytearray(make_frame(DFPlayerMini.FEEDBACK_REPLY))
+    corrupt[6] ^= 0x10
+    stream = (b'\x00\x7e\x13' + make_frame(DFPlayerMini.FEEDBACK_INIT_COMPLETE, 2)
+        + make_frame(DFPlayerMini.FEEDBACK_STATUS, 0x0201)[:6] + b'\x7e\xff'
+        + bytes(corrupt) + make_frame(DFPlayerMini.FEEDBACK_STATUS, 0x0201) + b'\xef\xef'
+        + make_frame(DFPlayerMini.TRACK_FINISHED_TF, 3))
+    #[WHEN]: the stream arrives in uneven chunks
+    events = []
+    for i in range(0, len(stream), 7):
+        player.uart.push(stream[i:i + 7])
+        events += read_events(player)
+    #[THEN]: every intact frame is reported, in order, and nothing else
+    assert [e[0] for e in events] == [DFPlayerMini.EVENT_INIT_COMPLETE, DFPlayerMini.EVENT_STATUS, DFPlayerMini.EVENT_TRACK_FINISHED], "Got {}".format(events)
+    assert events[1][2] == 0x0201 and events[2][2] == 3, "Expected the parameters intact"
+    assert player.rx_dropped > 0, "Expected the noise to be counted"
+
+def dfplayer_get_status_returns_early():
+    #[GIVEN]: a player with a status frame already waiting
+    player = make_player()
+    player.uart.push(make_frame(DFPlayerMini.FEEDBACK_STATUS, 0x0201))
+    #[WHEN]: the status is queried
+    start = utime.ticks_ms()
+    status = player.get_status()
+    #[THEN]: it is returned without waiting out the timeout
+    assert status == 0x01, "Expected the status byte, got {}".format(status)
+    assert utime.ticks_diff(utime.ticks_ms(), start) < 50, "Expected no fixed wait"
+
+def dfplayer_sends_the_same_packets_without_allocating():
+    #[GIVEN]: a player
+    player = make_player()
+    #[WHEN]: a command with a parameter, a constant command and a constant command with feedback are sent
+    player.send_command(DFPlayerMini.CMD_SET_VOLUME, 10)
+    player.send_command(DFPlayerMini.CMD_STOP)
+    player.send_command(DFPlayerMini.CMD_PLAY_TRACK, 0x0201, feedback=True)
+    player.send_command(DFPlayerMini.CMD_PAUSE, feedback=True)
+    #[THEN]: the packets match the frame format
+    packets = [packet for ticks, packet in player.uart.packets]
+    assert packets[0] == make_frame(DFPlayerMini.CMD_SET_VOLUME, 10), "Wrong volume packet"
+    assert packets[1] == make_frame(DFPlayerMini.CMD_STOP), "Wrong stop packet"
+    expected = bytearray(make_frame(DFPlayerMini.CMD_PLAY_TRACK, 0x0201))
+    expected[4] = 0x01
+    checksum = (expected[7] << 8 | expected[8]) - 1
+    expected[7], expected[8] = checksum >> 8, checksum & 0xFF
+    assert packets[2] == expected, "Wrong play packet with feedback"
+    assert player.validate_checksum(packets[3]) and packets[3][4] == 0x01, "Wrong pause packet with feedback"
+
+def dfplayer_send_many_keeps_spacing():
+    #[GIVEN]: a player that just sent a command
+    player = make_player()
+    player.stop()
+    #[WHEN]: a batch of commands is sent
+    player.send_many(((DFPlayerMini.CMD_SET_EQ, 4), (DFPlayerMini.CMD_SET_VOLUME, 10), (DFPlayerMini.CMD_PLAY_TRACK, 1)))
+    #[THEN]: all commands are sent in order with the spacing in between
+    packets = player.uart.packets
+    assert [packet[3] for ticks, packet in packets] == [DFPlayerMini.CMD_STOP, DFPlayerMini.CMD_SET_EQ, DFPlayerMini.CMD_SET_VOLUME, DFPlayerMini.CMD_PLAY_TRACK], "Wrong command order"
+    for i in range(1, len(packets)):
+        assert utime.ticks_diff(packets[i][0], packets[i - 1][0]) >= DFPlayerMini.COMMAND_SPACING_MS, "Commands sent too close together"
+
+def benchmark_send_command():
+    #[GIVEN]: a player on a uart that does not keep the packets
+    import gc
+    player = make_player(record=False)
+    rounds = 100
+    #[WHEN]: packets are built from a list for every command, the way send_command used to do it
+    gc.collect()
+    before = gc.mem_alloc()
+    for i in range(rounds):
+        checksum = player.calculate_checksum(DFPlayerMini.CMD_SET_VOLUME, 0, i & 0x1F)
+        player.uart.write(bytearray([0x7E, 0xFF, 0x06, DFPlayerMini.CMD_SET_VOLUME, 0x00, 0, i & 0x1F, checksum >> 8, checksum & 0xFF, 0xEF]))
+    list_bytes = gc.mem_alloc() - before
+    #[WHEN]: the same commands and a constant command are sent with the preallocated packets
+    gc.collect()
+    before = gc.mem_alloc()
+    for i in range(rounds):
+        player.send_command(DFPlayerMini.CMD_SET_VOLUME, i & 0x1F)
+        player.send_command(DFPlayerMini.CMD_STOP, feedback=True)
+    packet_bytes = gc.mem_alloc() - before
+    #[THEN]: we can compare the allocations per command
+    print("allocated per command: list {:.1f} bytes, preallocated {:.1f} bytes".format(list_bytes / rounds, packet_bytes / (2 * rounds)))
@@ -1,5 +1,9 @@
 # MicroPython SSD1306 OLED driver, I2C and SPI interfaces
+# modified to only send changed regions of the buffer on show(), tracked against a shadow copy of what the panel holds
+# modified to send command sequences in one transaction (write_cmds) instead of one transaction per command byte
+# modified so a show() of recurring windows does not allocate
 
+import micropython
 from micropython import const
 import framebuf
 
@@ -34,11 +38,22 @@ class SSD1306(framebuf.FrameBuffer):
         self.external_vcc = external_vcc
         self.pages = self.height // 8
         self.buffer = bytearray(self.pages * self.width)
+        self.shadow = bytearray(self.pages * self.width) # what the panel currently holds
+        self.buffer_mv = memoryview(self.buffer)
+        self.shadow_mv = memoryview(self.shadow)
+        self.full_refresh = True # panel contents unknown until the first full show()
+        self.bytes_sent = 0
+        self.last_show_bytes = 0
+        self.last_show_windows = 0
+        self.show_count = 0
+        self.window_cmds = bytearray((SET_COL_ADDR, 0, 0, SET_PAGE_ADDR, 0, 0))
+        self.window_views = {} # start << 11 | stop -> memoryview of the buffer, so recurring windows do not allocate
+        self.max_window_views = 128
         super().__init__(self.buffer, self.width, self.height, framebuf.MONO_VLSB)
         self.init_display()
 
     def init_display(self):
-        for cmd in (
+        self.write_cmds(bytes((
             SET_DISP,  # display off
             # address setting
             SET_MEM_ADDR,
@@ -71,8 +86,7 @@ class SSD1306(framebuf.FrameBuffer):
             SET_CHARGE_PUMP,
             0x10 if self.external_vcc else 0x14,
             SET_DISP | 0x01,  # display on
-        ):  # on
-            self.write_cmd(cmd)
+        )))
         self.fill(0)
         self.show()
 
@@ -82,32 +96,118 @@ class SSD1306(framebuf.FrameBuffer):
     def poweron(self):
         self.write_cmd(SET_DISP | 0x01)
 
+    def write_cmds(self, cmds):
+        # fallback for interfaces without a batched command path
+        for cmd in cmds:
+            self.write_cmd(cmd)
+
     def contrast(self, contrast):
-        self.write_cmd(SET_CONTRAST)
-        self.write_cmd(contrast)
+        self.write_cmds(bytes((SET_CONTRAST, contrast)))
 
     def invert(self, invert):
         self.write_cmd(SET_NORM_INV | (invert & 1))
 
     def rotate(self, rotate):
-        self.write_cmd(SET_COM_OUT_DIR | ((rotate & 1) << 3))
-        self.write_cmd(SET_SEG_REMAP | (rotate & 1))
+        self.write_cmds(bytes((SET_COM_OUT_DIR | ((rotate & 1) << 3), SET_SEG_REMAP | (rotate & 1))))
 
-    def show(self):
-        x0 = 0
-        x1 = self.width - 1
+    def invalidate(self):
+        # forget what the panel holds, next show() sends the full buffer
+        self.full_refresh = True
+
+    def set_window(self, x0, x1, page0, page1):
         if self.width != 128:
             # narrow displays use centred columns
             col_offset = (128 - self.width) // 2
             x0 += col_offset
             x1 += col_offset
-        self.write_cmd(SET_COL_ADDR)
-        self.write_cmd(x0)
-        self.write_cmd(x1)
-        self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
+        cmds = self.window_cmds
+        cmds[1] = x0
+        cmds[2] = x1
+        cmds[4] = page0
+        cmds[5] = page1
+        self.write_cmds(cmds)
+
+    def show_full(self):
+        self.set_window(0, self.width - 1, 0, self.pages - 1)
         self.write_data(self.buffer)
+        self.shadow_mv[:] = self.buffer_mv
+        self.full_refresh = False
+        return 1
+
+    @micropython.native
+    def show_dirty(self):
+        # one window per changed page, spanning the first to the last changed column of that page
+        # rounded out to 8 column tiles, so the same few windows recur and their memoryviews can be reused
+        width = self.width
+        buf = self.buffer_mv
+        shadow = self.shadow_mv
+        windows = 0
+        for page in range(self.pages):
+            offset = page * width
+            end = offset + width
+            start = offset
+            while start < end and buf[start] == shadow[start]:
+                start += 1
+            if start == end:
+                continue
+            stop = end - 1
+            while buf[stop] == shadow[stop]:
+                stop -= 1
+            start = offset + ((start - offset) & ~7)
+            stop = offset + ((stop - offset + 8) & ~7)
+            if stop > end:
+                stop = end
+            key = start << 11 | stop
+            view = self.window_views.get(key)
+            if view is None:
+                view = buf[start:stop]
+                if len(self.window_views) < self.max_window_views:
+                    self.window_views[key] = view
+            self.set_window(start - offset, stop - offset - 1, page, page)
+            self.write_data(view)
+            for i in range(start, stop):
+                shadow[i] = buf[i]
+            windows += 1
+        return windows
+
+    @micropython.native
+    def write_region(self, x0, x1, page0, page1, data):
+        # sends a prepared image straight into a window of the panel, data is laid out page by page
+        # buffer and shadow are updated as well, so later show() calls do not see it as a change
+        width = self.width
+        buf = self.buffer_mv
+        shadow = self.shadow_mv
+        i = 0
+        for page in range(page0, page1 + 1):
+            offset = page * width
+            for x in range(offset + x0, offset + x1 + 1):
+                buf[x] = data[i]
+                shadow[x] = data[i]
+                i += 1
+        self.set_window(x0, x1, page0, page1)
+        self.write_data(data)
+
+    def show(self):
+        bytes_before = self.bytes_sent
+        if self.full_refresh:
+            windows = self.show_full()
+        else:
+            windows = self.show_dirty()
+        self.last_show_windows = windows
+        self.last_show_bytes = self.bytes_sent - bytes_before
+        self.show_count += 1
+
+    def get_last_show_bytes(self):
+        return self.last_show_bytes
+
+    def get_bytes_sent(self):
+        return self.bytes_sent
+
+    def reset_counters(self):
+        self.bytes_sent = 0
+        self.last_show_bytes = 0
+        self.last_show_windows = 0
+        self.show_count = 0
 
 
 class SSD1306_I2C(SSD1306):
@@ -116,16 +216,24 @@ class SSD1306_I2C(SSD1306):
         self.addr = addr
         self.temp = bytearray(2)
         self.write_list = [b"\x40", None]  # Co=0, D/C#=1
+        self.cmd_list = [b"\x00", None]  # Co=0, D/C#=0, all following bytes are commands
         super().__init__(width, height, external_vcc)
 
     def write_cmd(self, cmd):
         self.temp[0] = 0x80  # Co=1, D/C#=0
         self.temp[1] = cmd
         self.i2c.writeto(self.addr, self.temp)
+        self.bytes_sent += 2
+
+    def write_cmds(self, cmds):
+        self.cmd_list[1] = cmds
+        self.i2c.writevto(self.addr, self.cmd_list)
+        self.bytes_sent += 1 + len(cmds)
 
     def write_data(self, buf):
         self.write_list[1] = buf
         self.i2c.writevto(self.addr, self.write_list)
+        self.bytes_sent += 1 + len(buf)
 
 
 class SSD1306_SPI(SSD1306):
@@ -154,6 +262,16 @@ class SSD1306_SPI(SSD1306):
         self.cs(0)
         self.spi.write(bytearray([cmd]))
         self.cs(1)
+        self.bytes_sent += 1
+
+    def write_cmds(self, cmds):
+        self.spi.init(baudrate=self.rate, polarity=0, phase=0)
+        self.cs(1)
+        self.dc(0)
+        self.cs(0)
+        self.spi.write(cmds)
+        self.cs(1)
+        self.bytes_sent += len(cmds)
 
     def write_data(self, buf):
         self.spi.init(baudrate=self.rate, polarity=0, phase=0)
@@ -161,4 +279,83 @@ class SSD1306_SPI(SSD1306):
         self.dc(1)
         self.cs(0)
         self.spi.write(buf)
-        self.cs(1)
\ No newline at end of file
+        self.cs(1)
+        self.bytes_sent += len(buf)
+
+
+## Mocks for testing
+# fake I2C bus, records what would go over the wire
+
+class MockI2C:
+    def __init__(self):
+        self.transactions = 0
+        self.bytes_written = 0
+
+    def writeto(self, addr, buf):
+        self.transactions += 1
+        self.bytes_written += len(buf)
+
+    def writevto(self, addr, bufs):
+        self.transactions += 1
+        for buf in bufs:
+            self.bytes_written += len(buf)
+
+    def reset(self):
+        self.transactions = 0
+        self.bytes_written = 0
+
+class MockUnbatchedSSD1306_I2C(SSD1306_I2C):
+    # sends one transaction per command byte, the way the driver did before write_cmds
+    def write_cmds(self, cmds):
+        for cmd in cmds:
+            self.write_cmd(cmd)
+
+## Tests
+
+def ssd1306_show_sends_only_changed_regions():
+    #[GIVEN]: SSD1306 on a fake I2C bus, initialized with a full refresh
+    print("Test SSD1306 partial show")
+    i2c = MockI2C()
+    display = SSD1306_I2C(128, 64, i2c)
+    full_bytes = display.get_last_show_bytes()
+    #[WHEN]: nothing changed
+    i2c.reset()
+    display.show()
+    #[THEN]: nothing is sent
+    assert display.get_last_show_bytes() == 0, "Expected no bytes for an unchanged buffer"
+    assert i2c.bytes_written == 0, "Expected no bytes on the bus for an unchanged buffer"
+    #[WHEN]: a battery icon sized region changes
+    display.fill_rect(108, 0, 20, 11, 1)
+    i2c.reset()
+    display.show()
+    #[THEN]: only the two touched pages are sent, columns 108-127 rounded out to the 8 column tiles 104-127
+    assert display.last_show_windows == 2, "Expected two windows"
+    assert i2c.bytes_written == display.get_last_show_bytes(), "Expected counter to match the bus"
+    window_bytes = (1 + len(display.window_cmds)) + (1 + 24) # window commands, then 24 columns of data
+    assert display.get_last_show_bytes() == 2 * window_bytes, "Expected 24 columns per page, got {} bytes".format(display.get_last_show_bytes())
+    print("Full show: {} bytes, battery icon show: {} bytes".format(full_bytes, display.get_last_show_bytes()))
+    #[WHEN]: the display is invalidated
+    display.invalidate()
+    display.show()
+    #[THEN]: the full buffer is sent again
+    assert display.get_last_show_bytes() == full_bytes, "Expected a full refresh after invalidate"
+
+def ssd1306_batches_commands():
+    #[GIVEN]: a batched and an unbatched SSD1306, each on a fake I2C bus
+    print("Test SSD1306 batched commands")
+    from utime import ticks_us, ticks_diff
+    for label, display_class in (('unbatched', MockUnbatchedSSD1306_I2C), ('batched', SSD1306_I2C)):
+        i2c = MockI2C()
+        display = display_class(128, 64, i2c)
+        init_transactions = i2c.transactions
+        #[WHEN]: the display shows a full frame
+        display.invalidate()
+        i2c.reset()
+        start = ticks_us()
+        display.show()
+        show_us = ticks_diff(ticks_us(), start)
+        #[THEN]: the batched display needs one transaction for the window and one for the data
+        if display_class is SSD1306_I2C:
+            assert i2c.transactions == 2, "Expected two transactions per batched show()"
+            assert init_transactions == 3, "Expected three transactions on init: commands, window and data"
+        print("{}: init {} transactions, show {} transactions, {} bytes, {} us".format(label, init_transactions, i2c.transactions, i2c.bytes_written, show_us))
@@ -0,0 +1,75 @@
+# packs all src/media/*.pbm into one binary bundle, src/media/assets.bin
+# run on the host (CPython) after changing any of the images: python tools/pack_media.py
+#
+# layout, all integers little endian:
+#   header  8 bytes: magic b'PBMB', version (u8), asset count (u8), 2 bytes reserved
+#   index  16 bytes per asset: name (10 bytes, ascii, zero padded), width (u8), height (u8), offset (u16), size (u16)
+#   data    raw MONO_HLSB bitmaps, offsets are counted from the start of the file
+
+import os
+import struct
+import sys
+
+MAGIC = b'PBMB'
+VERSION = 1
+HEADER_FORMAT = '<4sBBH'
+INDEX_FORMAT = '<10sBBHH'
+NAME_LENGTH = 10
+
+
+def read_pbm(path):
+    # raw (P4) pbm: magic, optional comments, width and height, then the bitmap
+    with open(path, 'rb') as f:
+        data = f.read()
+    tokens = []
+    pos = 0
+    while len(tokens) < 3:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.index(b'\n', pos) + 1
+            continue
+        start = pos
+        while not data[pos:pos + 1].isspace():
+            pos += 1
+        tokens.append(data[start:pos])
+    pos += 1  # single whitespace before the bitmap
+    if tokens[0] != b'P4':
+        raise ValueError('{} is not a raw pbm file'.format(path))
+    width = int(tokens[1])
+    height = int(tokens[2])
+    size = (width + 7) // 8 * height
+    bitmap = data[pos:pos + size]
+    if len(bitmap) != size:
+        raise ValueError('{} is truncated'.format(path))
+    return width, height, bitmap
+
+
+def pack(media_dir, bundle_path):
+    names = sorted(f[:-4] for f in os.listdir(media_dir) if f.endswith('.pbm'))
+    assets = []
+    for name in names:
+        if len(name) > NAME_LENGTH:
+            raise ValueError('asset name {} is longer than {} characters'.format(name, NAME_LENGTH))
+        assets.append((name,) + read_pbm(os.path.join(media_dir, name + '.pbm')))
+
+    offset = struct.calcsize(HEADER_FORMAT) + struct.calcsize(INDEX_FORMAT) * len(assets)
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(assets), 0)
+    index = b''
+    data = b''
+    for name, width, height, bitmap in assets:
+        index += struct.pack(INDEX_FORMAT, name.encode('ascii'), width, height, offset + len(data), len(bitmap))
+        data += bitmap
+
+    with open(bundle_path, 'wb') as f:
+        f.write(header + index + data)
+    return assets
+
+
+if __name__ == '__main__':
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'media')
+    media_dir = sys.argv[1] if len(sys.argv) > 1 else root
+    bundle_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(media_dir, 'assets.bin')
+    for name, width, height, bitmap in pack(media_dir, bundle_path):
+        print('{:<10} {:>3}x{:<3} {:>4} bytes'.format(name, width, height, len(bitmap)))
+    print('written to', bundle_path)